@@ -0,0 +1 @@
+debbisect
\ No newline at end of file
@@ -1,17 +1,739 @@
 # SPDX-FileCopyrightText: 2024 Johannes Schauer Marin Rodrigues <josch@debian.org>
 # SPDX-License-Identifier: MIT
 
+# pylint: disable=too-many-lines
+
+import argparse
+import bz2
+import collections
+import dataclasses
+import email.utils
+import fcntl
+import gzip
+import hashlib
 import http.server
+import json
 import logging
+import lzma
 import os
 import pathlib
+import re
 import shutil
+import socketserver
+import sqlite3
+import sys
 import tempfile
 import threading
+import time
 import urllib
+from concurrent.futures import ThreadPoolExecutor
 from functools import partial
 from http import HTTPStatus
 
+# ioctl to create a copy-on-write clone of a file (from linux/fs.h)
+FICLONE = 0x40049409
+
+
+# Files outside the pool (mostly the indices below dists/) are stored for
+# every timestamp separately even though neighbouring timestamps often share
+# them. To store their content only once, they are hardlinks to (or reflinks
+# of) a file below the sha256/ directory of the cache named after their hash.
+def object_path(cachedir, digest):
+    return pathlib.Path(cachedir, "sha256", digest[:2], digest)
+
+
+def is_pool_file(cachedir, path):
+    # archive/debian/<timestamp>/pool/... is a symlink into the shared pool
+    _, _, _, rest = path.relative_to(cachedir).as_posix().split("/", 3)
+    return rest.startswith("pool/")
+
+
+def file_sha256(path):
+    sha256 = hashlib.sha256()
+    with open(path, "rb") as f:
+        while True:
+            buf = f.read(1024 * 1024)
+            if not buf:
+                break
+            sha256.update(buf)
+    return sha256.hexdigest()
+
+
+def reflink(src, dst):
+    with open(src, "rb") as fsrc, open(dst, "wb") as fdst:
+        fcntl.ioctl(fdst.fileno(), FICLONE, fsrc.fileno())
+
+
+# Replace path by a hardlink to obj or, if that is not possible (for example
+# because obj already has too many links), by a reflink. Return whether path
+# was replaced.
+def replace_with_object(obj, path):
+    tmppath = path.with_suffix(f".{os.getpid()}.dedup")
+    try:
+        os.link(obj, tmppath)
+    except OSError:
+        try:
+            reflink(obj, tmppath)
+        except OSError:
+            tmppath.unlink(missing_ok=True)
+            return False
+    os.replace(tmppath, path)
+    return True
+
+
+# Make sure that the content of path is only stored once in the cache. Return
+# the number of bytes that were freed by doing so.
+def dedup_file(cachedir, path, digest):
+    obj = object_path(cachedir, digest)
+    if obj.exists():
+        if os.path.samefile(obj, path):
+            return 0
+        stat = path.stat()
+        if not replace_with_object(obj, path):
+            return 0
+        return stat.st_size if stat.st_nlink == 1 else 0
+    obj.parent.mkdir(parents=True, exist_ok=True)
+    try:
+        os.link(path, obj)
+    except FileExistsError:
+        # another process stored the same content at the same time
+        return dedup_file(cachedir, path, digest)
+    except OSError:
+        pass
+    return 0
+
+
+# Deduplicate all files outside the pool of an existing cache directory and
+# return the number of files and the number of bytes that were freed.
+def dedup_cache(cachedir):
+    files = freed = 0
+    for root, _, filenames in os.walk(pathlib.Path(cachedir, "archive")):
+        for name in filenames:
+            path = pathlib.Path(root, name)
+            if name.endswith(".part") or not path.is_file() or path.is_symlink():
+                continue
+            size = dedup_file(cachedir, path, file_sha256(path))
+            if size:
+                files += 1
+                freed += size
+    return files, freed
+
+
+# Persistent index of the files in the cache directory with their size, the
+# time of their last use and their hash. It is used to find partial files and
+# to evict the least recently used files once the cache grows too large
+# without walking the whole directory tree which can contain hundreds of
+# thousands of files. Paths are relative to the cache directory and point
+# into the shared pool directly for files below archive/debian/*/pool/.
+class CacheIndex:
+    def __init__(self, cachedir):
+        self.cachedir = pathlib.Path(cachedir)
+        dbpath = self.cachedir / "index.sqlite"
+        # a new index is filled from the content of the cache directory
+        self.is_new = not dbpath.exists()
+        self.lock = threading.Lock()
+        # a running total of the size of the cache that is never smaller than
+        # the one total_size() computes, or None if it is unknown
+        self.size = None
+        # multiple processes may share the same cache directory, so wait for
+        # the database to become unlocked
+        self.db = sqlite3.connect(
+            dbpath, timeout=60, isolation_level=None, check_same_thread=False
+        )
+        with self.lock:
+            self.db.execute("PRAGMA journal_mode=WAL")
+            self.db.execute(
+                "CREATE TABLE IF NOT EXISTS files ("
+                "path TEXT PRIMARY KEY, size INTEGER NOT NULL, "
+                "atime REAL NOT NULL, sha256 TEXT, partial INTEGER NOT NULL)"
+            )
+            self.db.execute("CREATE INDEX IF NOT EXISTS files_atime ON files (atime)")
+            self.db.execute("CREATE INDEX IF NOT EXISTS files_sha256 ON files (sha256)")
+            # the checksums that Release, Packages and Sources files list for
+            # the files they refer to
+            self.db.execute(
+                "CREATE TABLE IF NOT EXISTS checksums ("
+                "path TEXT PRIMARY KEY, sha256 TEXT NOT NULL)"
+            )
+            self.db.execute(
+                "CREATE INDEX IF NOT EXISTS checksums_sha256 ON checksums (sha256)"
+            )
+            # the hashes of the Packages and Sources files whose checksums
+            # were already added
+            self.db.execute(
+                "CREATE TABLE IF NOT EXISTS parsed (sha256 TEXT PRIMARY KEY)"
+            )
+        if self.is_new:
+            self.rebuild()
+
+    def close(self):
+        with self.lock:
+            self.db.close()
+
+    def execute(self, sql, parameters=()):
+        with self.lock:
+            return self.db.execute(sql, parameters).fetchall()
+
+    def key(self, path):
+        relpath = pathlib.Path(path).relative_to(self.cachedir).as_posix()
+        parts = relpath.split("/", 4)
+        if len(parts) == 5 and parts[0] == "archive" and parts[3] == "pool":
+            return "pool/" + parts[4]
+        return relpath
+
+    # Files that replace another one or whose content is already stored are
+    # counted again, which only makes the running total too large.
+    def add(self, path, size, sha256=None, is_partial=False):
+        with self.lock:
+            self.db.execute(
+                "INSERT OR REPLACE INTO files VALUES (?, ?, ?, ?, ?)",
+                (self.key(path), size, time.time(), sha256, int(is_partial)),
+            )
+            if self.size is not None and not is_partial:
+                self.size += size
+
+    def remove(self, path):
+        with self.lock:
+            rows = self.db.execute(
+                "SELECT size, sha256, partial FROM files WHERE path = ?",
+                (self.key(path),),
+            ).fetchall()
+            self.db.execute("DELETE FROM files WHERE path = ?", (self.key(path),))
+            if self.size is None or not rows or rows[0][2]:
+                return
+            size, sha256, _ = rows[0]
+            users = self.db.execute(
+                "SELECT 1 FROM files WHERE sha256 = ? LIMIT 1", (sha256,)
+            ).fetchall()
+            # the content is still stored if other paths use it
+            if not users:
+                self.size -= size
+
+    def touch(self, path):
+        self.execute(
+            "UPDATE files SET atime = ? WHERE path = ?", (time.time(), self.key(path))
+        )
+
+    def add_checksums(self, rows, parsed=None):
+        with self.lock:
+            self.db.execute("BEGIN")
+            self.db.executemany("INSERT OR REPLACE INTO checksums VALUES (?, ?)", rows)
+            if parsed is not None:
+                self.db.execute("INSERT OR IGNORE INTO parsed VALUES (?)", (parsed,))
+            self.db.execute("COMMIT")
+
+    def is_parsed(self, sha256):
+        return bool(self.execute("SELECT 1 FROM parsed WHERE sha256 = ?", (sha256,)))
+
+    # Return the hash that the content of the given file is supposed to have
+    # or None if it is unknown.
+    def expected_sha256(self, path):
+        path = pathlib.Path(path)
+        if path.parent.name == "SHA256" and path.parent.parent.name == "by-hash":
+            return path.name
+        rows = self.execute(
+            "SELECT sha256 FROM checksums WHERE path = ?", (self.key(path),)
+        )
+        return rows[0][0] if rows else None
+
+    # Return the name of a file with the given hash as it appears in a
+    # Release file. This is used to find out what a file that was retrieved
+    # by its hash is.
+    def name_of(self, sha256):
+        rows = self.execute(
+            "SELECT path FROM checksums WHERE sha256 = ? LIMIT 1", (sha256,)
+        )
+        return pathlib.PurePath(rows[0][0]).name if rows else None
+
+    # Move a file with unexpected content out of the way so that it is
+    # downloaded again the next time it is requested.
+    def quarantine(self, src, path):
+        dest = self.cachedir / "quarantine" / self.key(path)
+        dest.parent.mkdir(parents=True, exist_ok=True)
+        os.replace(src, dest)
+        self.remove(path)
+        logging.error("proxy: hash mismatch, moved %s to %s", path, dest)
+        return dest
+
+    def partial_files(self):
+        rows = self.execute("SELECT path FROM files WHERE partial = 1 ORDER BY path")
+        return [self.cachedir / path for (path,) in rows]
+
+    # Files with the same hash are stored only once (see dedup_file()), so
+    # they are only counted once.
+    def total_size(self):
+        ((total,),) = self.execute(
+            "SELECT COALESCE(SUM(size), 0) FROM ("
+            "SELECT size FROM files WHERE partial = 0 AND sha256 IS NULL "
+            "UNION ALL SELECT MAX(size) FROM files "
+            "WHERE partial = 0 AND sha256 IS NOT NULL GROUP BY sha256)"
+        )
+        return total
+
+    # Remove the least recently used files until the cache is not larger than
+    # max_size anymore. Return the number of bytes freed. The size of the
+    # cache is only computed from the whole index when the running total
+    # exceeds max_size. The checksums listed for the removed files are
+    # removed with them, and so is the mark that a removed Packages or
+    # Sources file was parsed, so that its checksums are added again once it
+    # is downloaded again.
+    def evict(self, max_size):
+        if self.size is not None and self.size <= max_size:
+            return 0
+        total = before = self.total_size()
+        with self.lock:
+            self.size = total
+        if total <= max_size:
+            return 0
+        rows = self.execute(
+            "SELECT path, size, sha256 FROM files WHERE partial = 0 ORDER BY atime"
+        )
+        for path, size, sha256 in rows:
+            if total <= max_size:
+                break
+            (self.cachedir / path).unlink(missing_ok=True)
+            self.execute("DELETE FROM files WHERE path = ?", (path,))
+            self.execute("DELETE FROM checksums WHERE path = ?", (path,))
+            if sha256 is not None:
+                ((users,),) = self.execute(
+                    "SELECT COUNT(*) FROM files WHERE sha256 = ?", (sha256,)
+                )
+                if users > 0:
+                    # the content is still in use by other paths
+                    continue
+                object_path(self.cachedir, sha256).unlink(missing_ok=True)
+                self.execute("DELETE FROM parsed WHERE sha256 = ?", (sha256,))
+            total -= size
+            logging.info("proxy: evicted %s from cache", path)
+        with self.lock:
+            # files may have been added in the meantime
+            self.size -= before - total
+        return before - total
+
+    # Fill the index from the files in the cache directory. This is only
+    # needed for cache directories that were created without an index.
+    def rebuild(self):
+        # the hash of deduplicated files is known from the stored objects
+        digests = {}
+        for obj in self.cachedir.glob("sha256/*/*"):
+            digests[obj.stat().st_ino] = obj.name
+        rows = []
+        for root, dirnames, filenames in os.walk(self.cachedir):
+            if root == str(self.cachedir):
+                for name in ["sha256", "quarantine"]:
+                    if name in dirnames:
+                        dirnames.remove(name)
+            for name in filenames:
+                path = pathlib.Path(root, name)
+                if name.startswith("index.sqlite") or path.is_symlink():
+                    continue
+                stat = path.stat()
+                rows.append(
+                    (
+                        self.key(path),
+                        stat.st_size,
+                        stat.st_atime,
+                        digests.get(stat.st_ino),
+                        int(name.endswith(".part")),
+                    )
+                )
+        with self.lock:
+            self.db.execute("BEGIN")
+            self.db.execute("DELETE FROM files")
+            self.db.executemany("INSERT INTO files VALUES (?, ?, ?, ?, ?)", rows)
+            self.db.execute("COMMIT")
+            self.size = None
+
+
+# Yield the stanzas of a Debian control file as dictionaries that map field
+# names to their value. Continuation lines are kept as part of the value.
+def control_stanzas(fileobj):
+    stanza = {}
+    field = None
+    for line in fileobj:
+        if line.startswith((" ", "\t")):
+            if field is not None:
+                stanza[field] += line
+        elif line.strip():
+            field, _, value = line.partition(":")
+            stanza[field] = value.strip() + "\n"
+        elif stanza:
+            yield stanza
+            stanza = {}
+            field = None
+    if stanza:
+        yield stanza
+
+
+# Yield the relative paths and SHA256 checksums listed in the given Release
+# or InRelease file.
+def release_checksums(path):
+    with open(path, encoding="utf-8", errors="replace") as f:
+        # the PGP armor of InRelease files ends up in stanzas without SHA256
+        for stanza in control_stanzas(f):
+            for line in stanza.get("SHA256", "").splitlines()[1:]:
+                digest, _, name = line.split()
+                yield name, digest
+
+
+# Yield the pool paths and SHA256 checksums of the packages listed in the
+# given Packages or Sources file. The name tells how it is compressed.
+def index_checksums(path, name):
+    opener = {".xz": lzma.open, ".gz": gzip.open, ".bz2": bz2.open}.get(
+        pathlib.PurePath(name).suffix, open
+    )
+    with opener(path, "rt", encoding="utf-8", errors="replace") as f:
+        for stanza in control_stanzas(f):
+            if "Filename" in stanza and "SHA256" in stanza:
+                yield stanza["Filename"].strip(), stanza["SHA256"].strip()
+            elif "Directory" in stanza and "Checksums-Sha256" in stanza:
+                directory = stanza["Directory"].strip()
+                for line in stanza["Checksums-Sha256"].splitlines()[1:]:
+                    digest, _, filename = line.split()
+                    yield f"{directory}/{filename}", digest
+
+
+INDEX_RE = re.compile(r"(Packages|Sources)(\.(gz|xz|bz2))?")
+
+
+# Remember the checksums listed in a Release, Packages or Sources file below
+# dists/ so that the files it refers to can be verified once they are
+# downloaded. Other files are ignored.
+def record_checksums(index, path, sha256):
+    path = pathlib.Path(path)
+    name = path.name
+    if path.parent.name == "SHA256" and path.parent.parent.name == "by-hash":
+        name = index.name_of(sha256)
+    if name in ("Release", "InRelease"):
+        base = index.key(path.parent)
+        index.add_checksums(
+            (f"{base}/{relpath}", digest) for relpath, digest in release_checksums(path)
+        )
+    elif name is not None and INDEX_RE.fullmatch(name):
+        # Packages files of neighbouring timestamps are often the same
+        if index.is_parsed(sha256):
+            return
+        try:
+            rows = list(index_checksums(path, name))
+        except (OSError, EOFError, lzma.LZMAError, ValueError) as e:
+            logging.warning("proxy: cannot read %s: %s", path, e)
+            return
+        index.add_checksums(rows, parsed=sha256)
+
+
+# Check the content of all files of an existing cache directory against the
+# checksums listed in the cached Release, Packages and Sources files. Files
+# with unexpected content are quarantined. Return the number of files that
+# were verified, quarantined and that could not be checked.
+def verify_cache(cachedir, jobs=None):
+    index = CacheIndex(cachedir)
+    try:
+        rows = index.execute("SELECT path, sha256 FROM files WHERE partial = 0")
+        paths = [(pathlib.Path(cachedir, path), sha256) for path, sha256 in rows]
+        # Release files have to come first because files retrieved by their
+        # hash are only recognized as Packages files through them
+        dists = sorted(
+            (p for p in paths if "/dists/" in p[0].as_posix()),
+            key=lambda p: p[0].name not in ("Release", "InRelease"),
+        )
+        for path, sha256 in dists:
+            record_checksums(index, path, sha256 or file_sha256(path))
+
+        expected = {path: index.expected_sha256(path) for path, _ in paths}
+        tocheck = [path for path, digest in expected.items() if digest is not None]
+        verified = quarantined = 0
+        with ThreadPoolExecutor(max_workers=jobs) as executor:
+            # hashlib releases the GIL while hashing, so threads run in
+            # parallel
+            for path, digest in zip(tocheck, executor.map(file_sha256, tocheck)):
+                if digest == expected[path]:
+                    verified += 1
+                else:
+                    index.quarantine(path, path)
+                    quarantined += 1
+        return verified, quarantined, len(expected) - len(tocheck)
+    finally:
+        index.close()
+
+
+def rebuild_index(cachedir):
+    index = CacheIndex(cachedir)
+    try:
+        # a new index was already filled from the cache directory
+        if not index.is_new:
+            index.rebuild()
+    finally:
+        index.close()
+
+
+def evict_cache(cachedir, max_size):
+    index = CacheIndex(cachedir)
+    try:
+        return index.evict(max_size)
+    finally:
+        index.close()
+
+
+def partial_files(cachedir):
+    index = CacheIndex(cachedir)
+    try:
+        return index.partial_files()
+    finally:
+        index.close()
+
+
+def parse_size(val):
+    match = re.fullmatch(r"(\d+)\s*([KMGT]?)(?:i?B)?", val.strip(), re.IGNORECASE)
+    if match is None:
+        raise argparse.ArgumentTypeError(f"cannot parse size value: {val}")
+    number, unit = match.groups()
+    return int(number) * 1024 ** " KMGT".index(unit.upper() or " ")
+
+
+# A download from snapshot.d.o that is currently in progress. Other requests
+# for the same file do not start their own download but wait for the one
+# already running and stream the data from its .part file as it gets written.
+# All members are protected by the condition variable.
+@dataclasses.dataclass
+class Download:  # pylint: disable=too-many-instance-attributes
+    tmppath: pathlib.Path
+    cond: threading.Condition = dataclasses.field(default_factory=threading.Condition)
+    # HTTP status returned by the upstream server
+    status: int | None = None
+    # headers to send to clients which follow this download
+    headers: list = dataclasses.field(default_factory=list)
+    # total size of the file or None until the response was received
+    length: int | None = None
+    # number of bytes in tmppath that can be read by followers
+    written: int = 0
+    followers: int = 0
+    done: bool = False
+    success: bool = False
+    sha256: str | None = None
+
+
+# A bounded pool of persistent connections to the upstream server. Instead of
+# paying for a new TCP handshake for every file that is not in the cache yet,
+# connections are kept open and reused by later requests. At most "size"
+# connections are in use at the same time which also limits how many
+# downloads run in parallel.
+class UpstreamPool:
+    def __init__(self, size):
+        self.slots = threading.BoundedSemaphore(size)
+        self.idle = collections.defaultdict(list)
+        self.lock = threading.Lock()
+
+    def get(self, host):
+        self.slots.acquire()  # pylint: disable=consider-using-with
+        with self.lock:
+            if self.idle[host]:
+                return self.idle[host].pop()
+        return http.client.HTTPConnection(host, timeout=30)
+
+    # Return a connection to the pool. Only connections on which the last
+    # response was read completely can be reused.
+    def put(self, host, conn, reusable):
+        if reusable and conn.sock is not None:
+            with self.lock:
+                self.idle[host].append(conn)
+        else:
+            conn.close()
+        self.slots.release()
+
+    def close(self):
+        with self.lock:
+            for conns in self.idle.values():
+                for conn in conns:
+                    conn.close()
+            self.idle.clear()
+
+
+# Return the key under which the redirect target of a cached file is
+# remembered. Files in the pool and files retrieved by their hash are the
+# same for all timestamps, so the timestamp is not part of their key.
+def redirect_key(relpath):
+    _, _, _, rest = relpath.split("/", 3)
+    if rest.startswith("pool/"):
+        return rest
+    if "/by-hash/" in rest:
+        return "by-hash/" + rest.split("/by-hash/", 1)[1]
+    return relpath
+
+
+# Counters of what the proxy did, to find out how much time a run spends
+# waiting for snapshot.d.o and how large the cache has to be. They are
+# served as JSON at /_stats and summarized when the proxy is shut down.
+class ProxyStats:
+    # upper bounds in seconds of the buckets of the upstream time to first
+    # byte histogram
+    TTFB_BUCKETS = [0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30]
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.counters = collections.Counter()
+        self.ttfb = [0] * (len(self.TTFB_BUCKETS) + 1)
+        self.ttfb_sum = 0.0
+        self.started = time.monotonic()
+
+    def add(self, name, value=1):
+        with self.lock:
+            self.counters[name] += value
+
+    def add_ttfb(self, seconds):
+        i = next(
+            (i for i, le in enumerate(self.TTFB_BUCKETS) if seconds <= le),
+            len(self.TTFB_BUCKETS),
+        )
+        with self.lock:
+            self.ttfb[i] += 1
+            self.ttfb_sum += seconds
+
+    # Return the upper bound of the histogram bucket containing the given
+    # quantile of the upstream time to first byte.
+    def ttfb_quantile(self, quantile):
+        with self.lock:
+            ttfb = list(self.ttfb)
+        count = sum(ttfb)
+        seen = 0
+        for i, num in enumerate(ttfb):
+            seen += num
+            if seen >= quantile * count:
+                break
+        return (self.TTFB_BUCKETS + [float("inf")])[i]
+
+    def as_dict(self):
+        with self.lock:
+            counters = {
+                name: self.counters[name]
+                for name in [
+                    "requests",
+                    "hits",
+                    "misses",
+                    "coalesced",
+                    "bytes_from_cache",
+                    "bytes_from_upstream",
+                    "bytes_coalesced",
+                    "redirects",
+                    "redirects_skipped",
+                    "timeouts",
+                    "quarantined",
+                ]
+            }
+            counters["seconds_serving_cache"] = round(
+                self.counters["seconds_serving_cache"], 3
+            )
+            counters["seconds_upstream"] = round(self.counters["seconds_upstream"], 3)
+            counters["uptime"] = round(time.monotonic() - self.started, 3)
+            buckets = [str(le) for le in self.TTFB_BUCKETS] + ["+Inf"]
+            counters["upstream_ttfb"] = {
+                "buckets": dict(zip(buckets, self.ttfb)),
+                "count": sum(self.ttfb),
+                "sum": round(self.ttfb_sum, 3),
+            }
+        return counters
+
+    def summary(self):
+        stats = self.as_dict()
+        mib = 1024 * 1024
+        lines = [
+            f"proxy: {stats['requests']} requests, {stats['hits']} cache hits, "
+            f"{stats['misses']} misses, {stats['coalesced']} shared downloads",
+            f"proxy: {stats['bytes_from_cache'] / mib:.1f} MiB served from cache "
+            f"in {stats['seconds_serving_cache']:.1f} s, "
+            f"{stats['bytes_from_upstream'] / mib:.1f} MiB downloaded "
+            f"in {stats['seconds_upstream']:.1f} s",
+            f"proxy: {stats['redirects']} redirects followed, "
+            f"{stats['redirects_skipped']} skipped, {stats['timeouts']} timeouts, "
+            f"{stats['quarantined']} corrupt downloads",
+        ]
+        ttfb = stats["upstream_ttfb"]
+        if ttfb["count"]:
+            lines.append(
+                "proxy: upstream time to first byte: "
+                f"mean {ttfb['sum'] / ttfb['count']:.2f} s, "
+                f"p50 <= {self.ttfb_quantile(0.5)} s, "
+                f"p90 <= {self.ttfb_quantile(0.9)} s"
+            )
+        return "\n".join(lines)
+
+
+# pylint: disable-next=too-many-instance-attributes
+class ProxyServer(socketserver.ThreadingMixIn, http.server.HTTPServer):
+    daemon_threads = True
+    MAX_REDIRECTS = 100000
+
+    def __init__(
+        self,
+        server_address,
+        RequestHandlerClass,
+        index,
+        concurrent=False,
+        connections=4,
+        max_size=None,
+    ):
+        super().__init__(server_address, RequestHandlerClass)
+        self.index = index
+        self.max_size = max_size
+        self.concurrent = concurrent
+        # maps cache paths to the Download currently writing them
+        self.downloads = {}
+        self.downloads_lock = threading.Lock()
+        self.upstream = UpstreamPool(connections)
+        # snapshot.d.o redirects every file below /archive/ to /file/<sha1>
+        # so we remember where we were sent to skip the redirect next time.
+        # Only the MAX_REDIRECTS most recently used targets are kept.
+        self.redirects = collections.OrderedDict()
+        self.redirects_lock = threading.Lock()
+        self.stats = ProxyStats()
+
+    def server_close(self):
+        super().server_close()
+        self.upstream.close()
+        self.index.close()
+
+    def process_request(self, request, client_address):
+        if self.concurrent:
+            super().process_request(request, client_address)
+        else:
+            # handle one request after the other
+            socketserver.BaseServer.process_request(self, request, client_address)
+
+    # Return a tuple of the Download for the given path and whether the
+    # caller is responsible for downloading it. If the file appeared in the
+    # cache in the meantime, return (None, False).
+    def start_download(self, path):
+        with self.downloads_lock:
+            download = self.downloads.get(path)
+            if download is not None:
+                with download.cond:
+                    download.followers += 1
+                return download, False
+            if path.exists() and path.stat().st_size > 0:
+                return None, False
+            # The PID is part of the name of the temporary file. That way,
+            # multiple concurrent processes can write out partial files
+            # without conflicting with each other and while still maintaining
+            # reproducible paths between individual calls of do_download() by
+            # the same process.
+            download = Download(path.with_suffix(f".{os.getpid()}.part"))
+            self.downloads[path] = download
+            return download, True
+
+    def finish_download(self, path, download):
+        with self.downloads_lock:
+            del self.downloads[path]
+        with download.cond:
+            download.done = True
+            download.cond.notify_all()
+        if download.success:
+            self.index.remove(download.tmppath)
+            self.index.add(path, download.length, download.sha256)
+            if self.max_size is not None:
+                self.index.evict(self.max_size)
+        elif download.tmppath.exists():
+            # the partial file is kept so that the download can be resumed
+            self.index.add(download.tmppath, download.written, is_partial=True)
+
 
 # we use a http proxy for two reasons
 #  1. it allows us to cache package data locally which is useful even for
@@ -23,14 +745,11 @@ from http import HTTPStatus
 #     serve the data with full speed once we have it locally
 #
 # We use SimpleHTTPRequestHandler over BaseHTTPRequestHandler for its directory
-# member. We disable its other features, namely do_HEAD
+# member. We disable its other features.
 class Proxy(http.server.SimpleHTTPRequestHandler):
-    def do_HEAD(self):
-        raise NotImplementedError
-
-    # no idea how to split this function into parts without making it
-    # unreadable
-    def do_GET(self):
+    # Check the request and return the location of the requested file in the
+    # cache or None if the request was answered with an error.
+    def cache_path(self):
         assert int(self.headers.get("Content-Length", 0)) == 0
         assert self.headers["Host"]
         pathprefix = "http://" + self.headers["Host"] + "/"
@@ -43,11 +762,11 @@ class Proxy(http.server.SimpleHTTPRequestHandler):
         except ValueError:
             logging.error("don't know how to handle this request: %s", self.path)
             self.send_error(HTTPStatus.BAD_REQUEST, f"Bad request path ({self.path})")
-            return
+            return None
         if ["archive", "debian"] != [chunk1, chunk2]:
             logging.error("don't know how to handle this request: %s", self.path)
             self.send_error(HTTPStatus.BAD_REQUEST, f"Bad request path ({self.path})")
-            return
+            return None
         # make sure the pool directory is symlinked to the global pool
         linkname = os.path.join(self.directory, chunk1, chunk2, timestamp, "pool")
         if not os.path.exists(linkname):
@@ -60,93 +779,303 @@ class Proxy(http.server.SimpleHTTPRequestHandler):
                 pass
 
         cachedir = pathlib.Path(self.directory)
-        path = cachedir / sanitizedpath
+        return cachedir / sanitizedpath
+
+    def do_HEAD(self):
+        path = self.cache_path()
+        if path is None:
+            return
+        self.server.stats.add("requests")
+        if path.exists() and path.stat().st_size > 0:
+            self.server.stats.add("hits")
+            self.send_cached(path, head_only=True)
+            return
+        # nothing to cache, so just pass the request on
+        host = self.headers["Host"]
+        conn = self.server.upstream.get(host)
+        reusable = False
+        try:
+            res = self.fetch_upstream(conn, "HEAD", path)
+            res.read()
+            reusable = True
+        except TimeoutError:
+            self.server.stats.add("timeouts")
+            self.send_error(HTTPStatus.GATEWAY_TIMEOUT)
+            return
+        finally:
+            self.server.upstream.put(host, conn, reusable)
+        self.wfile.write(f"HTTP/1.1 {res.status} {res.reason}\r\n".encode())
+        for key, value in res.getheaders():
+            if key.lower() == "connection":
+                continue
+            self.send_header(key, value)
+        self.end_headers()
+
+    def do_GET(self):
+        if self.path == "/_stats":
+            self.send_stats()
+            return
+        path = self.cache_path()
+        if path is None:
+            return
+        stats = self.server.stats
+        stats.add("requests")
 
         # just send back to client
         if path.exists() and path.stat().st_size > 0:
-            self.wfile.write(b"HTTP/1.1 200 OK\r\n")
-            self.send_header("Content-Length", path.stat().st_size)
-            self.end_headers()
-            with path.open(mode="rb") as new:
-                while True:
-                    buf = new.read(64 * 1024)  # same as shutil uses
-                    if not buf:
-                        break
-                    self.wfile.write(buf)
-            self.wfile.flush()
+            stats.add("hits")
+            self.server.index.touch(path)
+            self.send_cached(path)
             return
 
-        self.do_download(path)
+        download, leader = self.server.start_download(path)
+        if download is None:
+            # another request finished downloading this file in the meantime
+            stats.add("hits")
+            self.send_cached(path)
+        elif leader:
+            stats.add("misses")
+            begin = time.monotonic()
+            try:
+                self.do_download(path, download)
+            finally:
+                self.server.finish_download(path, download)
+                stats.add("seconds_upstream", time.monotonic() - begin)
+        else:
+            stats.add("coalesced")
+            self.follow_download(path, download)
+
+    # Answer a request for /_stats with the counters of the proxy.
+    def send_stats(self):
+        body = json.dumps(self.server.stats.as_dict(), indent=2).encode() + b"\n"
+        self.send_response(HTTPStatus.OK)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", len(body))
+        self.end_headers()
+        self.wfile.write(body)
+
+    # Return whether the client already has the current version of a file
+    # with the given ETag and modification time.
+    def is_not_modified(self, etag, mtime):
+        if self.headers.get("If-None-Match"):
+            return etag in [t.strip() for t in self.headers["If-None-Match"].split(",")]
+        if self.headers.get("If-Modified-Since"):
+            try:
+                since = email.utils.parsedate_to_datetime(
+                    self.headers["If-Modified-Since"]
+                )
+            except (TypeError, ValueError):
+                return False
+            return int(mtime) <= since.timestamp()
+        return False
+
+    # Parse the Range header of a request for a file of the given size.
+    # Return None if the whole file should be sent, the tuple (first, last) of
+    # byte positions to send or False if the range cannot be satisfied.
+    def requested_range(self, size, etag, last_modified):
+        value = self.headers.get("Range")
+        if not value or not value.startswith("bytes=") or "," in value:
+            # multiple ranges are not supported, so we send the whole file
+            return None
+        if_range = self.headers.get("If-Range")
+        if if_range and if_range not in (etag, last_modified):
+            return None
+        first, _, last = value.removeprefix("bytes=").strip().partition("-")
+        try:
+            if not first:
+                # suffix range: the last N bytes
+                first, last = max(size - int(last), 0), size - 1
+            else:
+                first, last = int(first), min(int(last) if last else size - 1, size - 1)
+        except ValueError:
+            return None
+        if first > last or first >= size:
+            return False
+        return first, last
+
+    # Answer a request from a file in the cache. Its content is passed to the
+    # socket by the kernel instead of copying it through Python.
+    def send_cached(self, path, head_only=False):
+        with path.open(mode="rb") as fileobj:
+            stat = os.fstat(fileobj.fileno())
+            size = stat.st_size
+            etag = f'"{size:x}-{stat.st_mtime_ns:x}"'
+            last_modified = email.utils.formatdate(stat.st_mtime, usegmt=True)
+            if self.is_not_modified(etag, stat.st_mtime):
+                self.wfile.write(b"HTTP/1.1 304 Not Modified\r\n")
+                self.send_header("ETag", etag)
+                self.send_header("Last-Modified", last_modified)
+                self.end_headers()
+                return
+            byterange = self.requested_range(size, etag, last_modified)
+            if byterange is False:
+                self.wfile.write(b"HTTP/1.1 416 Range Not Satisfiable\r\n")
+                self.send_header("Content-Range", f"bytes */{size}")
+                self.send_header("Content-Length", 0)
+                self.end_headers()
+                return
+            if byterange is None:
+                offset, count = 0, size
+                self.wfile.write(b"HTTP/1.1 200 OK\r\n")
+            else:
+                offset, count = byterange[0], byterange[1] - byterange[0] + 1
+                self.wfile.write(b"HTTP/1.1 206 Partial Content\r\n")
+                self.send_header(
+                    "Content-Range", f"bytes {byterange[0]}-{byterange[1]}/{size}"
+                )
+            self.send_header("Content-Length", count)
+            self.send_header("Accept-Ranges", "bytes")
+            self.send_header("ETag", etag)
+            self.send_header("Last-Modified", last_modified)
+            self.end_headers()
+            if head_only:
+                return
+            begin = time.monotonic()
+            try:
+                # uses os.sendfile() if possible
+                self.connection.sendfile(fileobj, offset, count)
+            except (BrokenPipeError, ConnectionResetError):
+                pass
+            else:
+                self.server.stats.add("bytes_from_cache", count)
+            self.server.stats.add("seconds_serving_cache", time.monotonic() - begin)
+
+    def range_start(self):
+        assert self.headers["Range"].startswith("bytes=")
+        assert self.headers["Range"].endswith("-")
+        return int(self.headers["Range"].removeprefix("bytes=").removesuffix("-"))
+
+    # Stream a file that another request is currently downloading. The data
+    # is read from the .part file of that download as soon as it was written.
+    def follow_download(self, path, download):
+        try:
+            self.stream_download(path, download)
+        finally:
+            with download.cond:
+                download.followers -= 1
+
+    # pylint: disable=too-many-branches
+    def stream_download(self, path, download):
+        start = self.range_start() if self.headers.get("Range") else 0
+        with download.cond:
+            while download.length is None and not download.done:
+                download.cond.wait()
+            if download.done and download.success:
+                # the file was completely downloaded before we got here
+                fileobj = None
+            elif (
+                download.length is None
+                or start > download.length
+                or (download.done and not download.success)
+            ):
+                status = download.status
+                if status is None or status in (
+                    HTTPStatus.OK,
+                    HTTPStatus.PARTIAL_CONTENT,
+                ):
+                    status = HTTPStatus.BAD_GATEWAY
+                try:
+                    self.send_error(status)
+                except BrokenPipeError:
+                    pass
+                return
+            else:
+                # open the file while holding the lock so that the download
+                # cannot rename it away from under us
+                fileobj = download.tmppath.open(mode="rb")
+        if fileobj is None:
+            self.send_cached(path)
+            return
+        with fileobj:
+            if start > 0:
+                self.wfile.write(b"HTTP/1.1 206 Partial Content\r\n")
+                self.send_header(
+                    "Content-Range",
+                    f"bytes {start}-{download.length - 1}/{download.length}",
+                )
+            else:
+                self.wfile.write(b"HTTP/1.1 200 OK\r\n")
+            self.send_header("Content-Length", download.length - start)
+            for key, value in download.headers:
+                self.send_header(key, value)
+            self.end_headers()
+            fileobj.seek(start, os.SEEK_SET)
+            pos = start
+            while pos < download.length:
+                with download.cond:
+                    while download.written <= pos and not download.done:
+                        download.cond.wait()
+                    available = download.written
+                if available <= pos:
+                    # the download was aborted
+                    break
+                buf = fileobj.read(min(available - pos, 64 * 1024))
+                if not buf:
+                    break
+                pos += len(buf)
+                try:
+                    self.wfile.write(buf)
+                except BrokenPipeError:
+                    break
+                self.server.stats.add("bytes_coalesced", len(buf))
+        self.wfile.flush()
 
-    # pylint: disable=too-many-branches,too-many-statements
-    def do_download(self, path):
+    def do_download(self, path, download):
         # download fresh copy
-        todownload = downloaded_bytes = 0
         partial_size = None
-        # The PID is part of the name of the temporary file. That way, multiple
-        # concurrent processes can write out partial files without conflicting
-        # with each other and while still maintaining reproducible paths
-        # between individual calls of do_download() by the same process.
-        tmppath = path.with_suffix(f".{os.getpid()}.part")
+        tmppath = download.tmppath
         if self.headers.get("Range"):
             assert tmppath.is_file()
-            assert self.headers["Range"].startswith("bytes=")
-            assert self.headers["Range"].endswith("-")
-            reqrange = int(
-                self.headers["Range"].removeprefix("bytes=").removesuffix("-")
-            )
+            reqrange = self.range_start()
             assert reqrange <= tmppath.stat().st_size
             partial_size = reqrange
         else:
             tmppath.parent.mkdir(parents=True, exist_ok=True)
-        conn = http.client.HTTPConnection(self.headers["Host"], timeout=30)
-        conn.request("GET", self.path, None, dict(self.headers))
+        host = self.headers["Host"]
+        conn = self.server.upstream.get(host)
+        reusable = False
         try:
-            res = conn.getresponse()
-        except TimeoutError:
             try:
-                self.send_error(504)  # Gateway Timeout
-            except BrokenPipeError:
-                pass
-            return
-        if res.status == 302:
-            # clean up connection so it can be reused for the 302 redirect
-            res.read()
-            res.close()
-            newpath = res.getheader("Location")
-            assert newpath.startswith("/file/"), newpath
-            conn.request("GET", newpath, None, dict(self.headers))
-            try:
-                res = conn.getresponse()
+                res = self.fetch_upstream(conn, "GET", path)
             except TimeoutError:
+                self.server.stats.add("timeouts")
+                download.status = HTTPStatus.GATEWAY_TIMEOUT
                 try:
                     self.send_error(504)  # Gateway Timeout
                 except BrokenPipeError:
                     pass
                 return
+            reusable = self.relay_download(path, download, res, partial_size)
+        finally:
+            self.server.upstream.put(host, conn, reusable)
+
+    # Send the upstream response to the client and write it to the cache.
+    # Return whether the response was read completely.
+    # pylint: disable=too-many-branches,too-many-statements,too-many-locals
+    def relay_download(self, path, download, res, partial_size):
+        tmppath = download.tmppath
+        download.status = res.status
+        if res.status != (200 if partial_size is None else 206):
+            res.read()
+            try:
+                self.send_error(res.status)
+            except BrokenPipeError:
+                pass
+            return True
         if partial_size is not None:
-            if res.status != 206:
-                try:
-                    self.send_error(res.status)
-                except BrokenPipeError:
-                    pass
-                return
             self.wfile.write(b"HTTP/1.1 206 Partial Content\r\n")
             logging.info("proxy: resuming download from byte %d", partial_size)
         else:
-            if res.status != 200:
-                try:
-                    self.send_error(res.status)
-                except BrokenPipeError:
-                    pass
-                return
             self.wfile.write(b"HTTP/1.1 200 OK\r\n")
         todownload = int(res.getheader("Content-Length"))
+        headers = []
         for key, value in res.getheaders():
             # do not allow a persistent connection
-            if key == "connection":
+            if key.lower() in ("connection", "keep-alive"):
                 continue
             self.send_header(key, value)
+            if key.lower() not in ("content-length", "content-range"):
+                headers.append((key, value))
         self.end_headers()
         if partial_size is not None:
             total_size = todownload + partial_size
@@ -158,58 +1087,205 @@ class Proxy(http.server.SimpleHTTPRequestHandler):
                 f"bytes {partial_size}-{total_size - 1}/{total_size}",
             )
         downloaded_bytes = 0
-        with tmppath.open(mode="ab") as file:
+        client_connected = True
+        sha256 = hashlib.sha256()
+        with tmppath.open(mode="ab+") as file:
             if partial_size is not None and file.tell() != partial_size:
                 file.seek(partial_size, os.SEEK_SET)
+            offset = file.tell()
+            if offset > 0:
+                # the hash has to include what was downloaded before
+                file.seek(0, os.SEEK_SET)
+                while file.tell() < offset:
+                    sha256.update(file.read(min(offset - file.tell(), 1024 * 1024)))
+            with download.cond:
+                download.headers = headers
+                download.length = offset + todownload
+                download.written = offset
+                download.cond.notify_all()
             # we are not using shutil.copyfileobj() because we want to
             # write to two file objects simultaneously and throttle the
             # writing speed to 1024 kB/s
+            # Every chunk is only passed on to the client and the followers
+            # once the next one arrived. That way, the last chunk can be
+            # withheld if the checksum of the complete file turns out wrong.
+            pending = b""
             while True:
                 buf = res.read(64 * 1024)  # same as shutil uses
                 if not buf:
                     break
                 downloaded_bytes += len(buf)
-                try:
-                    self.wfile.write(buf)
-                except BrokenPipeError:
-                    break
+                self.server.stats.add("bytes_from_upstream", len(buf))
                 file.write(buf)
+                sha256.update(buf)
+                file.flush()
+                client_connected, followers = self.pass_on(
+                    download,
+                    pending,
+                    offset + downloaded_bytes - len(buf),
+                    client_connected,
+                )
+                pending = buf
+                # only keep downloading without our client if others are
+                # waiting for the data
+                if not client_connected and followers == 0:
+                    break
                 # now that snapshot.d.o is fixed, we do not need to throttle
                 # the download speed anymore
                 # sleep(0.5)  # 128 kB/s
-        self.wfile.flush()
-        if todownload == downloaded_bytes and downloaded_bytes > 0:
-            tmppath.rename(path)
+        complete = todownload == downloaded_bytes and downloaded_bytes > 0
+        digest = sha256.hexdigest()
+        expected = self.server.index.expected_sha256(path) if complete else None
+        # Neither the client nor the followers get the last chunk of a corrupt
+        # download. As the connection is closed after every response, apt sees
+        # an incomplete response instead of a complete but corrupt file.
+        if expected is None or digest == expected:
+            client_connected, _ = self.pass_on(
+                download, pending, offset + downloaded_bytes, client_connected
+            )
+        if client_connected:
+            self.wfile.flush()
+        if complete:
+            # use the modification time from the server so that
+            # If-Modified-Since requests from apt can be answered from the
+            # cache
+            if res.getheader("Last-Modified"):
+                try:
+                    mtime = email.utils.parsedate_to_datetime(
+                        res.getheader("Last-Modified")
+                    ).timestamp()
+                except (TypeError, ValueError):
+                    pass
+                else:
+                    os.utime(tmppath, (mtime, mtime))
+            if expected is not None and digest != expected:
+                # do not let a corrupt download poison the cache
+                with download.cond:
+                    self.server.index.quarantine(tmppath, path)
+                self.server.stats.add("quarantined")
+                return res.isclosed()
+            with download.cond:
+                tmppath.rename(path)
+                download.sha256 = digest
+                download.success = True
+            if not is_pool_file(self.directory, path):
+                dedup_file(self.directory, path, digest)
+                record_checksums(self.server.index, path, digest)
+        return res.isclosed()
+
+    # Make the data of a download up to byte "written" of its .part file
+    # available to the followers and send buf, the end of that data, to the
+    # client. Return whether the client is still connected and the number of
+    # followers.
+    def pass_on(self, download, buf, written, client_connected):
+        with download.cond:
+            download.written = written
+            download.cond.notify_all()
+            followers = download.followers
+        if client_connected and buf:
+            try:
+                self.wfile.write(buf)
+            except BrokenPipeError:
+                client_connected = False
+        return client_connected, followers
+
+    # Send a request to the upstream server and follow its redirect. For
+    # files that we were redirected for before, the redirect target is
+    # requested directly.
+    def fetch_upstream(self, conn, method, path):
+        headers = {
+            key: value
+            for key, value in self.headers.items()
+            if key.lower() not in ("connection", "proxy-connection", "keep-alive")
+        }
+        key = redirect_key(path.relative_to(self.directory).as_posix())
+        with self.server.redirects_lock:
+            target = self.server.redirects.get(key)
+            if target is not None:
+                self.server.redirects.move_to_end(key)
+        if target is not None:
+            res = self.upstream_request(conn, method, target, headers)
+            if res.status in (200, 206):
+                self.server.stats.add("redirects_skipped")
+                return res
+            res.read()
+            with self.server.redirects_lock:
+                self.server.redirects.pop(key, None)
+        res = self.upstream_request(conn, method, self.path, headers)
+        if res.status == 302:
+            # clean up connection so it can be reused for the 302 redirect
+            res.read()
+            res.close()
+            target = res.getheader("Location")
+            assert target.startswith("/file/"), target
+            with self.server.redirects_lock:
+                self.server.redirects[key] = target
+                self.server.redirects.move_to_end(key)
+                if len(self.server.redirects) > self.server.MAX_REDIRECTS:
+                    self.server.redirects.popitem(last=False)
+            self.server.stats.add("redirects")
+            res = self.upstream_request(conn, method, target, headers)
+        return res
+
+    def upstream_request(self, conn, method, url, headers):
+        begin = time.monotonic()
+        try:
+            conn.request(method, url, None, headers)
+            res = conn.getresponse()
+        except ConnectionError:
+            # the server closed the persistent connection in the meantime,
+            # so try again with a new one
+            conn.close()
+            begin = time.monotonic()
+            conn.request(method, url, None, headers)
+            res = conn.getresponse()
+        # getresponse() returns once the status line and headers arrived
+        self.server.stats.add_ttfb(time.monotonic() - begin)
+        return res
 
     # pylint: disable=redefined-builtin
     def log_message(self, format, *args):
         pass
 
 
-def setupcache(cache, port):
-    if cache:
-        cachedir = cache
-        for path in pathlib.Path(cachedir).glob("**/*.part"):
-            # we are not deleting *.part files so that multiple processes can
-            # use the cache at the same time without having their *.part files
-            # deleted by another process
-            logging.warning(
-                "found partial file in cache, consider deleting it manually: %s", path
-            )
-    else:
-        cachedir = tempfile.mkdtemp(prefix="debbisect")
+def create_server(
+    cachedir, address, port, concurrent=False, connections=4, max_size=None
+):
     logging.info("using cache directory: %s", cachedir)
     os.makedirs(cachedir + "/pool", exist_ok=True)
+    index = CacheIndex(cachedir)
+    for path in index.partial_files():
+        # we are not deleting *.part files so that multiple processes can
+        # use the cache at the same time without having their *.part files
+        # deleted by another process
+        logging.warning(
+            "found partial file in cache, consider deleting it manually: %s", path
+        )
+    if max_size is not None:
+        index.evict(max_size)
 
-    # we are not using a ThreadedHTTPServer because
-    #  - additional complexity needed if one download created a .part file
-    #    then apt stops reading while we still try to read from snapshot and
-    #    apt retries the same download trying to write to the same .part file
-    #    opened in another threat
-    #  - snapshot.d.o really doesn't like fast downloads, so we do it serially
-    httpd = http.server.HTTPServer(
-        server_address=("127.0.0.1", port),
+    # By default, requests are handled one after another because
+    # snapshot.d.o really doesn't like fast downloads. In concurrent mode,
+    # every request gets its own thread so that cache hits do not have to
+    # wait for a download to finish. Concurrent requests for the same file
+    # do not race on the same .part file but share a single download.
+    return ProxyServer(
+        server_address=(address, port),
         RequestHandlerClass=partial(Proxy, directory=cachedir),
+        index=index,
+        concurrent=concurrent,
+        connections=connections,
+        max_size=max_size,
+    )
+
+
+def setupcache(cache, port, concurrent=False, connections=4, max_size=None):
+    if cache:
+        cachedir = cache
+    else:
+        cachedir = tempfile.mkdtemp(prefix="debbisect")
+    httpd = create_server(
+        cachedir, "127.0.0.1", port, concurrent, connections, max_size
     )
     # run server in a new thread
     server_thread = threading.Thread(target=httpd.serve_forever)
@@ -223,6 +1299,8 @@ def setupcache(cache, port):
         httpd.shutdown()
         httpd.server_close()
         server_thread.join()
+        if httpd.stats.counters["requests"]:
+            print(httpd.stats.summary(), file=sys.stderr)
         if not cache:
             # this should be a temporary directory but lets still be super
             # careful
@@ -230,6 +1308,126 @@ def setupcache(cache, port):
                 shutil.rmtree(cachedir + "/pool")
             if os.path.exists(cachedir + "/archive"):
                 shutil.rmtree(cachedir + "/archive")
+            for name in ["sha256", "quarantine"]:
+                if os.path.exists(cachedir + "/" + name):
+                    shutil.rmtree(cachedir + "/" + name)
+            for suffix in ["", "-wal", "-shm"]:
+                if os.path.exists(cachedir + "/index.sqlite" + suffix):
+                    os.unlink(cachedir + "/index.sqlite" + suffix)
             os.rmdir(cachedir)
 
     return port, teardown
+
+
+# pylint: disable-next=too-many-locals
+def main(arguments: list[str]) -> None:
+    parser = argparse.ArgumentParser(
+        prog="python3 -m devscripts.proxy",
+        description="Maintain the cache directory of the caching proxy used by "
+        "debbisect and debootsnap.",
+    )
+    subparsers = parser.add_subparsers(dest="command", required=True)
+    parser_serve = subparsers.add_parser(
+        "serve",
+        help="run the caching proxy in the foreground so that multiple "
+        "debbisect and debootsnap processes can share it via their "
+        "--proxy-url option. Files requested by several processes at the same "
+        "time are only downloaded once. Counters of cache hits, misses and "
+        "upstream latency are available as JSON at /_stats.",
+    )
+    parser_serve.add_argument("cache", help="cache directory")
+    parser_serve.add_argument(
+        "--bind",
+        default="127.0.0.1",
+        help="address to listen on (default: 127.0.0.1)",
+    )
+    parser_serve.add_argument(
+        "--port", type=int, default=0, help="port to listen on (default: any)"
+    )
+    parser_serve.add_argument(
+        "--upstream-connections",
+        type=int,
+        default=4,
+        help="maximum number of persistent connections to snapshot.debian.org "
+        "(default: 4)",
+    )
+    parser_serve.add_argument(
+        "--cache-max-size",
+        type=parse_size,
+        help="maximum size of the cache directory like 500M or 20G",
+    )
+    parser_dedup = subparsers.add_parser(
+        "dedup",
+        help="store identical files outside the pool only once by replacing "
+        "them with hardlinks (or reflinks) to a single copy",
+    )
+    parser_dedup.add_argument("cache", help="cache directory")
+    parser_reindex = subparsers.add_parser(
+        "reindex",
+        help="recreate the index of cached files from the content of the "
+        "cache directory",
+    )
+    parser_reindex.add_argument("cache", help="cache directory")
+    parser_evict = subparsers.add_parser(
+        "evict",
+        help="remove the least recently used files until the cache is not "
+        "larger than the given size",
+    )
+    parser_evict.add_argument("cache", help="cache directory")
+    parser_evict.add_argument(
+        "max_size", type=parse_size, help="maximum size like 500M or 20G"
+    )
+    parser_verify = subparsers.add_parser(
+        "verify",
+        help="check the content of the cached files against the checksums "
+        "listed in the cached Release, Packages and Sources files and move "
+        "corrupt files to the quarantine/ directory of the cache",
+    )
+    parser_verify.add_argument("cache", help="cache directory")
+    parser_verify.add_argument(
+        "--jobs",
+        type=int,
+        help="number of files to hash in parallel (default: number of CPUs)",
+    )
+    args = parser.parse_args(arguments)
+
+    if args.command == "serve":
+        logging.basicConfig(level=logging.INFO)
+        httpd = create_server(
+            args.cache,
+            args.bind,
+            args.port,
+            concurrent=True,
+            connections=args.upstream_connections,
+            max_size=args.cache_max_size,
+        )
+        address, port = httpd.server_address
+        print(f"caching proxy listening on http://{address}:{port}/", flush=True)
+        try:
+            httpd.serve_forever()
+        except KeyboardInterrupt:
+            pass
+        finally:
+            httpd.server_close()
+            print(httpd.stats.summary(), file=sys.stderr)
+    elif args.command in ("dedup", "reindex"):
+        if args.command == "dedup":
+            files, freed = dedup_cache(args.cache)
+            print(f"deduplicated {files} files, freed {freed / 1024 / 1024:.1f} MiB")
+        # after dedup, the index does not know about the new hashes yet
+        rebuild_index(args.cache)
+    elif args.command == "evict":
+        freed = evict_cache(args.cache, args.max_size)
+        print(f"freed {freed / 1024 / 1024:.1f} MiB")
+    elif args.command == "verify":
+        verified, quarantined, unknown = verify_cache(args.cache, args.jobs)
+        print(
+            f"{verified} files are correct, {quarantined} were corrupt and "
+            f"quarantined, {unknown} could not be checked"
+        )
+        if quarantined:
+            sys.exit(1)
+
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
@@ -0,0 +1,717 @@
+# SPDX-License-Identifier: MIT
+
+"""Test the helper functions of the debbisect script."""
+
+import contextlib
+import gzip
+import hashlib
+import io
+import json
+import lzma
+import os
+import shutil
+import tempfile
+import threading
+import time
+import types
+import unittest
+import unittest.mock
+from datetime import datetime, timedelta, timezone
+
+from debian.debian_support import Version
+
+from debbisect import SnapshotMetadata, SnapshotTimestamps
+from debbisect import TestLog as DebbisectTestLog
+from debbisect import (
+    Trace,
+    add_pkgset,
+    cached_chroot_differs,
+    chroot_cache_dir,
+    chroot_cache_env,
+    ddmin,
+    evict_chroot_cache,
+    first_seen_of_version,
+    get_log_fname,
+    next_candidates,
+    parse_simulation,
+    pkgversions_between,
+    prefetch_indices,
+    read_pkgsets,
+    reuse_verdicts,
+    runtest_cmd,
+    scan_index,
+    simulate_pkgs,
+    split_range,
+    steps_left,
+    write_log_symlink,
+)
+
+
+class FakeResponse:
+    """Imitation of a requests.Response."""
+
+    status_code = 200
+
+    def __init__(self, text: str = "", json_data=None, content: bytes = b"") -> None:
+        self.text = text
+        self.json_data = json_data
+        self.content = content
+
+    def raise_for_status(self) -> None:
+        """Do nothing like a successful response."""
+
+    def json(self):
+        """Return the JSON data of the response."""
+        return self.json_data
+
+    def iter_content(self, chunk_size: int):
+        """Yield the content in chunks."""
+        for i in range(0, len(self.content), chunk_size):
+            yield self.content[i : i + chunk_size]
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args) -> None:
+        pass
+
+
+class FakeSession:  # pylint: disable=too-few-public-methods
+    """Imitation of a requests.Session recording the requests."""
+
+    def __init__(self, responses: dict) -> None:
+        self.responses = responses
+        self.requests: list = []
+
+    def get(self, url: str, params=None, **_):
+        """Return the response for the given URL and parameters."""
+        if params:
+            url += "?" + "&".join(f"{k}={v}" for k, v in params.items())
+        self.requests.append(url)
+        return self.responses[url]
+
+
+def utc(*args: int) -> datetime:
+    """Return a datetime in UTC."""
+    return datetime(*args, tzinfo=timezone.utc)
+
+
+class TestBisectSteps(unittest.TestCase):
+    """Test how debbisect splits the range of candidate timestamps."""
+
+    def test_split_range(self) -> None:
+        """Test that split_range() splits into parts of the same size."""
+        candidates = list(range(11))
+        self.assertEqual(split_range(candidates, 1), [5])
+        self.assertEqual(split_range(candidates, 2), [3, 7])
+        self.assertEqual(split_range(candidates, 3), [2, 5, 8])
+        self.assertEqual(split_range([1, 2], 3), [1, 2])
+        self.assertEqual(split_range([], 1), [])
+
+    def test_steps_left(self) -> None:
+        """Test that steps_left() matches bisecting with split_range()."""
+        self.assertEqual(steps_left(0, 1), 0)
+        self.assertEqual(steps_left(1, 1), 1)
+        self.assertEqual(steps_left(7, 1), 3)
+        self.assertEqual(steps_left(8, 1), 4)
+        self.assertEqual(steps_left(8, 3), 2)
+        for n in [1, 2, 3, 4]:
+            for count in range(40):
+                # the worst case of splitting the candidates step by step
+                candidates, steps = list(range(count)), 0
+                while candidates:
+                    tested = split_range(candidates, n)
+                    parts = [
+                        candidates[i + 1 : j]
+                        for i, j in zip(
+                            [-1] + [candidates.index(t) for t in tested],
+                            [candidates.index(t) for t in tested] + [len(candidates)],
+                        )
+                    ]
+                    candidates = max(parts, key=len)
+                    steps += 1
+                self.assertEqual(steps_left(count, n), steps, (count, n))
+
+    def test_next_candidates(self) -> None:
+        """Test that the candidates of every possible next step are found."""
+        between = list(range(11))
+        self.assertEqual(next_candidates(between, [5], 1), [2, 8])
+        self.assertEqual(next_candidates(between, [3, 7], 2), [0, 1, 4, 5, 8, 9])
+        # the next range for each outcome is split like in the next step
+        for outcome in range(3):
+            part = [[0, 1, 2], [4, 5, 6], [8, 9, 10]][outcome]
+            for ts in split_range(part, 2):
+                self.assertIn(ts, next_candidates(between, [3, 7], 2))
+
+
+class TestDdmin(unittest.TestCase):
+    """Test the search for the packages responsible for a problem."""
+
+    def test_single_culprit(self) -> None:
+        """Test that a single culprit is found in few tests."""
+        tested = []
+
+        def test(group: list) -> bool:
+            tested.append(group)
+            return "p37" in group
+
+        pkgs = [f"p{i}" for i in range(64)]
+        self.assertEqual(ddmin(pkgs, test, 1), ["p37"])
+        self.assertLessEqual(len(tested), 2 * 6)
+
+    def test_culprits_only_together(self) -> None:
+        """Test that packages only failing together are found together."""
+        pkgs = [f"p{i}" for i in range(10)]
+        for jobs in [1, 3]:
+            self.assertEqual(
+                ddmin(pkgs, lambda g: "p2" in g and "p7" in g, jobs), ["p2", "p7"]
+            )
+
+    def test_results_are_recorded_in_main_thread(self) -> None:
+        """Test that record() runs in the calling thread with --jobs."""
+        threads = set()
+        recorded = []
+
+        def record(group: list, result: bool) -> bool:
+            threads.add(threading.current_thread())
+            recorded.append(group)
+            return result
+
+        pkgs = [f"p{i}" for i in range(16)]
+        self.assertEqual(ddmin(pkgs, lambda g: "p5" in g, 4, record), ["p5"])
+        self.assertEqual(threads, {threading.current_thread()})
+        self.assertIn(["p5"], recorded)
+
+
+class TestSnapshotTimestamps(unittest.TestCase):
+    """Test the month lists of snapshot timestamps."""
+
+    def setUp(self) -> None:
+        self.cachedir = tempfile.mkdtemp(prefix="devscripts-")
+        self.addCleanup(shutil.rmtree, self.cachedir)
+        url = "http://snapshot.debian.org/archive/debian/?year=2020&month={}"
+        self.session = FakeSession(
+            {
+                url.format(1): FakeResponse(
+                    '<a href="20200131T000000Z/">x</a><a href="20200101T120000Z/">'
+                ),
+                url.format(2): FakeResponse('<a href="20200201T000000Z/">x</a>'),
+            }
+        )
+        self.timestamps = SnapshotTimestamps(self.cachedir)
+        self.timestamps.session = self.session
+
+    def test_month_is_parsed_and_cached(self) -> None:
+        """Test that a month is downloaded once and stored in the cache."""
+        self.assertEqual(
+            self.timestamps.month(2020, 1), [utc(2020, 1, 1, 12), utc(2020, 1, 31)]
+        )
+        with open(os.path.join(self.cachedir, "2020-01"), encoding="ascii") as f:
+            self.assertEqual(f.read(), "20200101T120000Z\n20200131T000000Z\n")
+        # a new instance reads the complete month from the cache
+        timestamps = SnapshotTimestamps(self.cachedir)
+        timestamps.session = FakeSession({})
+        self.assertEqual(len(timestamps.month(2020, 1)), 2)
+        self.assertEqual(len(self.session.requests), 1)
+
+    def test_incomplete_month_is_downloaded_again(self) -> None:
+        """Test that a month stored before it ended is not trusted."""
+        path = os.path.join(self.cachedir, "2020-01")
+        with open(path, "w", encoding="ascii") as f:
+            f.write("20200101T120000Z\n")
+        stored = utc(2020, 1, 20).timestamp()
+        os.utime(path, (stored, stored))
+        self.assertEqual(len(self.timestamps.month(2020, 1)), 2)
+        self.assertGreater(os.path.getmtime(path), time.time() - 60)
+
+    def test_months_without_snapshots(self) -> None:
+        """Test that months before snapshot.d.o and in the future are empty."""
+        self.assertEqual(self.timestamps.month(2005, 2), [])
+        self.assertEqual(self.timestamps.month(datetime.now().year + 1, 1), [])
+        self.assertEqual(self.session.requests, [])
+
+    def test_between_and_sanitize(self) -> None:
+        """Test the lookups across month boundaries."""
+        self.assertEqual(
+            self.timestamps.between(utc(2020, 1, 1, 12), utc(2020, 2, 1)),
+            [utc(2020, 1, 31)],
+        )
+        self.assertEqual(self.timestamps.sanitize(utc(2020, 2, 1, 6)), utc(2020, 2, 1))
+        self.assertEqual(
+            self.timestamps.sanitize(utc(2020, 1, 31, 6)), utc(2020, 1, 31)
+        )
+
+    def test_between_only_first_seen(self) -> None:
+        """Test that --first-seen restricts the bisected timestamps."""
+        self.timestamps.only = {utc(2020, 1, 31)}
+        self.assertEqual(
+            self.timestamps.between(utc(2020, 1, 1), utc(2020, 2, 2)),
+            [utc(2020, 1, 31)],
+        )
+
+
+class TestSnapshotMetadata(unittest.TestCase):
+    """Test the queries of the package metadata on snapshot.debian.org."""
+
+    def setUp(self) -> None:
+        self.cachedir = tempfile.mkdtemp(prefix="devscripts-")
+        self.addCleanup(shutil.rmtree, self.cachedir)
+        mr = "http://snapshot.debian.org/mr/"
+        fileinfo = {
+            "h1": [{"archive_name": "debian", "first_seen": "20200105T000000Z"}],
+            "h2": [
+                {"archive_name": "debian-ports", "first_seen": "20200101T000000Z"},
+                {"archive_name": "debian", "first_seen": "20200107T000000Z"},
+            ],
+        }
+        self.session = FakeSession(
+            {
+                mr
+                + "binary/foo/": FakeResponse(
+                    json_data={"result": [{"version": v} for v in ["3", "2", "1"]]}
+                ),
+                mr
+                + "binary/foo/2/binfiles?fileinfo=1": FakeResponse(
+                    json_data={
+                        "result": [
+                            {"architecture": "amd64", "hash": "h1"},
+                            {"architecture": "arm64", "hash": "h2"},
+                        ],
+                        "fileinfo": fileinfo,
+                    }
+                ),
+            }
+        )
+        self.metadata = SnapshotMetadata(self.cachedir)
+        self.metadata.session = self.session
+
+    def test_mr_cache(self) -> None:
+        """Test that cached answers are stored on disk and reused."""
+        path = "binary/foo/2/binfiles?fileinfo=1"
+        first = self.metadata.mr(path, cache=True)
+        metadata = SnapshotMetadata(self.cachedir)
+        metadata.session = FakeSession({})
+        self.assertEqual(metadata.mr(path, cache=True), first)
+        self.assertEqual(
+            os.listdir(os.path.join(self.cachedir, "mr")),
+            [hashlib.sha256(path.encode()).hexdigest()],
+        )
+        # answers that can still change are not cached
+        self.metadata.mr("binary/foo/")
+        self.metadata.mr("binary/foo/")
+        self.assertEqual(len(self.session.requests), 3)
+
+    def test_first_seen_of_version(self) -> None:
+        """Test that only files of the debian archive and architecture count."""
+        self.assertEqual(
+            first_seen_of_version(self.metadata, "binary", "foo", "2", "amd64"),
+            {utc(2020, 1, 5)},
+        )
+        self.assertEqual(
+            first_seen_of_version(self.metadata, "binary", "foo", "2", "arm64"),
+            {utc(2020, 1, 7)},
+        )
+
+    def test_pkgversions_between(self) -> None:
+        """Test that versions outside the good and bad ones are skipped."""
+        versions = {utc(2020, 1, 1): "1", utc(2020, 2, 1): "2"}
+        self.metadata.binary_version = lambda pkg, timestamp, suite, arch: Version(
+            versions[timestamp]
+        )
+        self.assertEqual(
+            pkgversions_between(
+                self.metadata, "foo", utc(2020, 1, 1), utc(2020, 2, 1), "sid", "amd64"
+            ),
+            [("binary", "foo", "2"), ("binary", "foo", "1")],
+        )
+
+    def test_versions_index(self) -> None:
+        """Test that an index is downloaded once and kept in the database."""
+        url = "http://snapshot.debian.org/archive/debian/20200101T000000Z/"
+        path = "dists/sid/main/binary-amd64/Packages.xz"
+        self.session.responses[url + path] = FakeResponse(
+            content=lzma.compress(
+                b"Package: foo\nVersion: 2\n\nPackage: foo\nVersion: 1\n\n"
+            )
+        )
+        for _ in range(2):
+            self.assertEqual(
+                self.metadata.binary_version("foo", utc(2020, 1, 1), "sid", "amd64"),
+                Version("2"),
+            )
+        self.assertEqual(self.session.requests, [url + path])
+        self.assertIsNone(
+            self.metadata.binary_version("bar", utc(2020, 1, 1), "sid", "amd64")
+        )
+
+
+class TestScanIndex(unittest.TestCase):
+    """Test the streaming parser of Packages and Sources indices."""
+
+    def test_scan_index(self) -> None:
+        """Test that Package and Version are found in any chunking."""
+        index = (
+            b"Package: foo\nDescription: a\n long\n text\nVersion: 1.0-1\n\n"
+            b"Version: 2\nPackage: bar\nVersion: ignored\n\n"
+            b"Package: no-version\n\n"
+            b"Package: last\nVersion: 3"
+        )
+        data = lzma.compress(index)
+        expected = [("foo", "1.0-1"), ("bar", "2"), ("last", "3")]
+        for size in [1, 7, len(data)]:
+            chunks = (data[i : i + size] for i in range(0, len(data), size))
+            self.assertEqual(list(scan_index(chunks)), expected, size)
+
+    def test_scan_gzip_index(self) -> None:
+        """Test that other fields of gzip compressed indices are found."""
+        index = b"Package: foo\nFilename: pool/main/f/foo/foo_1_all.deb\n\n"
+        chunks = [gzip.compress(index)]
+        self.assertEqual(
+            list(scan_index(chunks, ("Package", "Filename"), "gz")),
+            [("foo", "pool/main/f/foo/foo_1_all.deb")],
+        )
+
+    def test_prefetch_indices(self) -> None:
+        """Test that the pool paths are found in the streamed Packages file."""
+        mirror = "http://snapshot.debian.org/archive/debian/20200101T000000Z"
+        packages = lzma.compress(
+            b"Package: foo\nFilename: pool/main/f/foo/foo_1_all.deb\n\n"
+            b"Package: bar\nFilename: pool/main/b/bar/bar_1_all.deb\n"
+        )
+        release = (
+            "SHA256:\n"
+            f" {hashlib.sha256(packages).hexdigest()} {len(packages)}"
+            " main/binary-amd64/Packages.xz\n"
+        )
+        session = FakeSession(
+            {
+                f"{mirror}/dists/sid/InRelease": FakeResponse(content=release.encode()),
+                f"{mirror}/dists/sid/main/binary-amd64/Packages.xz": FakeResponse(
+                    content=packages
+                ),
+            }
+        )
+        staticargs = types.SimpleNamespace(
+            suite="sid", components="main", architecture=b"amd64"
+        )
+        self.assertEqual(
+            prefetch_indices(session, mirror, staticargs, {"bar", "baz"}),
+            ["pool/main/b/bar/bar_1_all.deb"],
+        )
+        self.assertEqual(prefetch_indices(session, mirror, staticargs, set()), [])
+        self.assertEqual(len(session.requests), 4)
+
+
+class TestLogs(unittest.TestCase):
+    """Test how the output of tests is stored."""
+
+    def setUp(self) -> None:
+        tmpdir = tempfile.mkdtemp(prefix="devscripts-")
+        self.addCleanup(shutil.rmtree, tmpdir)
+        self.addCleanup(os.chdir, os.getcwd())
+        os.chdir(tmpdir)
+
+    def test_tail_is_bounded(self) -> None:
+        """Test that only the end of the output is kept in memory."""
+        log = DebbisectTestLog()
+        for i in range(100):
+            log.write(bytes([i]) * 1024)
+        log.close()
+        self.assertEqual(len(log.tail), DebbisectTestLog.TAIL_SIZE)
+        self.assertEqual(log.tail[-1], 99)
+        self.assertEqual(os.path.getsize(log.path), 100 * 1024)
+        log.discard()
+        self.assertEqual(os.listdir("."), [])
+
+    def test_compressed_log(self) -> None:
+        """Test that the output of a test is streamed to an xz log file."""
+        ret, log = runtest_cmd(
+            ["sh", "-c", "echo output; exit 3"], {}, live=False, compression="xz"
+        )
+        self.assertEqual(ret, 3)
+        self.assertEqual(bytes(log.tail), b"output\n")
+        ts = utc(2020, 1, 1)
+        write_log_symlink("bad", log, ts)
+        fname = "debbisect.20200101T000000Z.log.bad.xz"
+        self.assertEqual(get_log_fname(ts, "bad"), fname)
+        self.assertEqual(os.readlink("debbisect.log.bad"), fname)
+        with lzma.open(fname) as f:
+            self.assertEqual(f.read(), b"output\n")
+        # a new result replaces the old log whatever its compression
+        write_log_symlink("bad", b"message\n", ts)
+        self.assertEqual(
+            sorted(os.listdir(".")),
+            ["debbisect.20200101T000000Z.log.bad", "debbisect.log.bad"],
+        )
+
+
+class TestChrootCache(unittest.TestCase):
+    """Test the cache of chroot tarballs of --chroot-cache."""
+
+    def setUp(self) -> None:
+        self.cachedir = tempfile.mkdtemp(prefix="devscripts-")
+        self.addCleanup(shutil.rmtree, self.cachedir)
+        self.staticargs = types.SimpleNamespace(
+            chroot_cache=self.cachedir,
+            chroot_cache_max_size=None,
+            depends="pkg1",
+            architecture="arch",
+            suite="unstable",
+            components="main",
+        )
+
+    def add_tarball(self, keydir: str, name: str, size: int, mtime: int) -> str:
+        """Write a tarball of the given size and modification time."""
+        os.makedirs(os.path.join(self.cachedir, keydir), exist_ok=True)
+        path = os.path.join(self.cachedir, keydir, name)
+        with open(path, "wb") as f:
+            f.write(b"\0" * size)
+        os.utime(path, (mtime, mtime))
+        return path
+
+    @unittest.mock.patch("debbisect.simulate_pkgs")
+    def test_chroot_cache_env(self, simulate_mock) -> None:
+        """Test that the latest tarball not after the timestamp is the base."""
+        simulate_mock.return_value = [(b"pkg1", b"1.0"), (b"pkg2", b"2.0")]
+        keydir = os.path.basename(chroot_cache_dir(self.staticargs))
+        self.add_tarball(keydir, "20200101T000000Z.tar", 1, 1000)
+        self.add_tarball(keydir, "20200103T000000Z.tar", 1, 1000)
+        self.add_tarball(keydir, "20200105T000000Z.tar", 1, 1000)
+        self.add_tarball(keydir, "20200104T000000Z.tar.tmp", 1, 1000)
+        env = chroot_cache_env(utc(2020, 1, 4), self.staticargs, None)
+        cachedir = os.path.join(self.cachedir, keydir)
+        base = os.path.join(cachedir, "20200103T000000Z.tar")
+        self.assertEqual(env["DEBIAN_BISECT_CHROOT_BASE"], base)
+        self.assertGreater(os.path.getmtime(base), 1000)
+        self.assertEqual(
+            env["DEBIAN_BISECT_CHROOT_SAVE"],
+            os.path.join(cachedir, "20200104T000000Z.tar"),
+        )
+        with open(env["DEBIAN_BISECT_CHROOT_PKGS"], encoding="utf-8") as f:
+            self.assertEqual(f.read(), "pkg1 1.0\npkg2 2.0\n")
+        # a chroot with an upgraded package is not stored
+        env = chroot_cache_env(utc(2020, 1, 3), self.staticargs, "pkg1")
+        self.assertEqual(env["DEBIAN_BISECT_CHROOT_BASE"], base)
+        self.assertNotIn("DEBIAN_BISECT_CHROOT_SAVE", env)
+        # there is no tarball to start from
+        env = chroot_cache_env(utc(2019, 12, 31), self.staticargs, None)
+        self.assertEqual(list(env), ["DEBIAN_BISECT_CHROOT_SAVE"])
+        # without the packages of a fresh chroot, the tarballs are not used
+        simulate_mock.return_value = None
+        env = chroot_cache_env(utc(2020, 1, 4), self.staticargs, None)
+        self.assertEqual(list(env), ["DEBIAN_BISECT_CHROOT_SAVE"])
+
+    @unittest.mock.patch("debbisect.simulate_pkgs")
+    def test_cached_chroot_differs(self, simulate_mock) -> None:
+        """Test that the package list and its .differ marker are removed."""
+        simulate_mock.return_value = [(b"pkg1", b"1.0")]
+        keydir = os.path.basename(chroot_cache_dir(self.staticargs))
+        self.add_tarball(keydir, "20200101T000000Z.tar", 1, 1000)
+        self.assertFalse(cached_chroot_differs({}))
+        env = chroot_cache_env(utc(2020, 1, 2), self.staticargs, None)
+        self.assertFalse(cached_chroot_differs(env))
+        env = chroot_cache_env(utc(2020, 1, 2), self.staticargs, None)
+        with open(env["DEBIAN_BISECT_CHROOT_PKGS"] + ".differ", "wb"):
+            pass
+        self.assertTrue(cached_chroot_differs(env))
+        self.assertEqual(
+            os.listdir(os.path.join(self.cachedir, keydir)), ["20200101T000000Z.tar"]
+        )
+
+    def test_evict_across_all_options(self) -> None:
+        """Test that the size limit covers the tarballs of all options."""
+        self.add_tarball("key1", "20200101T000000Z.tar", 100, 1000)
+        self.add_tarball("key2", "20200102T000000Z.tar", 100, 3000)
+        self.add_tarball("key2", "20200103T000000Z.tar", 100, 2000)
+        self.add_tarball("key2", "20200103T000000Z.1234.pkgs", 100, 0)
+        evict_chroot_cache(self.staticargs)
+        self.assertEqual(len(os.listdir(os.path.join(self.cachedir, "key2"))), 3)
+        self.staticargs.chroot_cache_max_size = 150
+        evict_chroot_cache(self.staticargs)
+        self.assertEqual(os.listdir(os.path.join(self.cachedir, "key1")), [])
+        self.assertEqual(
+            sorted(os.listdir(os.path.join(self.cachedir, "key2"))),
+            ["20200102T000000Z.tar", "20200103T000000Z.1234.pkgs"],
+        )
+
+
+class TestSimulatePkgs(unittest.TestCase):
+    """Test resolving the packages of a fresh chroot with run_bisect.sh."""
+
+    def setUp(self) -> None:
+        self.tmpdir = tempfile.mkdtemp(prefix="devscripts-")
+        self.addCleanup(shutil.rmtree, self.tmpdir)
+        mmdebstrap = os.path.join(self.tmpdir, "mmdebstrap")
+        with open(mmdebstrap, "w", encoding="utf-8") as f:
+            f.write(
+                "#!/bin/sh\n"
+                'printf "%s\\n" "$@" > "$(dirname "$0")/args"\n'
+                "echo 'Inst pkg1 (1.0 Debian:unstable [all])'\n"
+                "echo 'Conf pkg1 (1.0 Debian:unstable [all])'\n"
+            )
+        os.chmod(mmdebstrap, 0o755)
+        path = self.tmpdir + ":" + os.environ.get("PATH", "/usr/bin:/bin")
+        patcher = unittest.mock.patch.dict(os.environ, {"PATH": path})
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def test_same_options_as_fresh_chroot(self) -> None:
+        """Test that the packages are resolved like for a fresh chroot."""
+        staticargs = types.SimpleNamespace(
+            proxy=None,
+            depends="pkg1",
+            script="true",
+            architecture=b"arch",
+            suite="unstable",
+            components="main",
+            trace=Trace(os.path.join(self.tmpdir, "trace")),
+        )
+        self.assertEqual(
+            simulate_pkgs(utc(2020, 1, 1), staticargs), [(b"pkg1", b"1.0")]
+        )
+        with open(os.path.join(self.tmpdir, "args"), encoding="utf-8") as f:
+            args = f.read().splitlines()
+        self.assertIn("--simulate", args)
+        self.assertIn("--hook-dir=/usr/share/mmdebstrap/hooks/maybe-merged-usr", args)
+        self.assertIn("--include=pkg1", args)
+        self.assertEqual(
+            args[-3:],
+            [
+                "unstable",
+                "/dev/null",
+                "http://snapshot.debian.org/archive/debian/20200101T000000Z",
+            ],
+        )
+
+
+SIMULATE_OUTPUT = b"""\
+I: chroot architecture amd64 is equal to the host's architecture
+I: automatically chosen format: directory
+I: running apt-get update...
+I: downloading packages with apt...
+I: skipping download because of --simulate
+Inst base-files (12.4 Debian:unstable [amd64])
+Inst libc6:amd64 (2.36-9 Debian:unstable [amd64])
+Inst tzdata (2024a-1 Debian:unstable [all])
+Conf base-files (12.4 Debian:unstable [amd64])
+Conf libc6:amd64 (2.36-9 Debian:unstable [amd64])
+Conf tzdata (2024a-1 Debian:unstable [all])
+I: skipping extract/install because of --simulate
+"""
+
+
+class TestMemoize(unittest.TestCase):
+    """Test reusing the verdicts of timestamps with the same packages."""
+
+    def setUp(self) -> None:
+        tmpdir = tempfile.mkdtemp(prefix="devscripts-")
+        self.addCleanup(shutil.rmtree, tmpdir)
+        self.addCleanup(os.chdir, os.getcwd())
+        os.chdir(tmpdir)
+
+    def test_parse_simulation(self) -> None:
+        """Test parsing the output of mmdebstrap --simulate."""
+        self.assertEqual(
+            parse_simulation(SIMULATE_OUTPUT),
+            [
+                (b"base-files", b"12.4"),
+                (b"libc6", b"2.36-9"),
+                (b"tzdata", b"2024a-1"),
+            ],
+        )
+        # a package that is unpacked but never configured is an error
+        incomplete = SIMULATE_OUTPUT.replace(b"Conf tzdata", b"Remv tzdata")
+        self.assertEqual(parse_simulation(incomplete), [])
+        self.assertEqual(parse_simulation(b"E: Unable to locate package\n"), [])
+
+    def test_pkgsets_file(self) -> None:
+        """Test that the verdicts are stored by the hash of their packages."""
+        self.assertEqual(read_pkgsets(), {})
+        add_pkgset("hash1", "good", utc(2020, 1, 1))
+        add_pkgset("hash2", "bad", utc(2020, 1, 2))
+        self.assertEqual(
+            read_pkgsets(),
+            {
+                "hash1": ("good", "20200101T000000Z"),
+                "hash2": ("bad", "20200102T000000Z"),
+            },
+        )
+
+    @unittest.mock.patch("debbisect.resolve_pkgset")
+    def test_reuse_verdicts(self, resolve_mock) -> None:
+        """Test that only timestamps with known package sets are skipped."""
+        add_pkgset("hash1", "bad", utc(2020, 1, 1))
+        with open("debbisect.20200101T000000Z.pkglist", "w", encoding="utf-8") as f:
+            f.write("pkg1\t1.0\n")
+        hashes = {utc(2020, 1, 2): "hash1", utc(2020, 1, 3): "hash2"}
+        hashes[utc(2020, 1, 4)] = None
+        resolve_mock.side_effect = lambda ts, staticargs: hashes[ts]
+        stdout = io.StringIO()
+        with contextlib.redirect_stdout(stdout):
+            verdicts, totest = reuse_verdicts(
+                list(hashes), types.SimpleNamespace(jobs=2)
+            )
+        self.assertEqual(verdicts, {utc(2020, 1, 2): "bad"})
+        self.assertEqual(totest, {utc(2020, 1, 3): "hash2", utc(2020, 1, 4): None})
+        self.assertIn("reusing its result (bad)", stdout.getvalue())
+        with open("debbisect.20200102T000000Z.pkglist", encoding="utf-8") as f:
+            self.assertEqual(f.read(), "pkg1\t1.0\n")
+        with open("debbisect.log.bad", encoding="utf-8") as f:
+            self.assertIn("were tested for 20200101T000000Z", f.read())
+
+
+class TestTrace(unittest.TestCase):
+    """Test the timing trace of a bisection."""
+
+    def setUp(self) -> None:
+        tmpdir = tempfile.mkdtemp(prefix="devscripts-")
+        self.addCleanup(shutil.rmtree, tmpdir)
+        self.fname = os.path.join(tmpdir, "debbisect.trace.jsonl")
+        self.trace = Trace(self.fname)
+
+    def records(self) -> list:
+        """Return the records written to the trace file."""
+        with open(self.fname, encoding="utf-8") as f:
+            return [json.loads(line) for line in f]
+
+    def test_eta_is_median_of_steps(self) -> None:
+        """Test that the estimate is not skewed by a single slow step."""
+        self.assertIsNone(self.trace.eta(3))
+        self.trace.steps = [10.0, 1000.0, 20.0]
+        self.assertEqual(self.trace.eta(3), timedelta(seconds=60))
+        self.trace.steps.append(30.0)
+        self.assertEqual(self.trace.eta(2), timedelta(seconds=50))
+
+    def test_step_and_phases(self) -> None:
+        """Test that steps and the phases of a test are recorded."""
+        with self.trace.step(3):
+            start = datetime.now(timezone.utc)
+            with self.trace.marks_file() as marks:
+                with open(marks, "w", encoding="utf-8") as f:
+                    f.write(f"script {start.timestamp() + 0.5}\n")
+                self.trace.add_test(utc(2020, 1, 1), start, marks)
+        self.assertEqual(len(self.trace.steps), 1)
+        records = self.records()
+        self.assertEqual(
+            [(r["step"], r["phase"]) for r in records],
+            [(3, "test"), (3, "chroot"), (3, "script"), (3, "step")],
+        )
+        self.assertEqual(records[0]["timestamp"], "20200101T000000Z")
+        self.assertAlmostEqual(records[1]["duration"], 0.5, places=2)
+        self.assertFalse(os.path.exists(marks))
+
+    def test_marks_file_removed_on_error(self) -> None:
+        """Test that the marks file does not outlive a failing test."""
+        with self.assertRaises(OSError):
+            with self.trace.marks_file() as marks:
+                raise OSError("test failed")
+        self.assertFalse(os.path.exists(marks))
+
+    def test_proxy_stats_url(self) -> None:
+        """Test that the statistics are found with and without a slash."""
+        for proxy in ["http://127.0.0.1:3128", "http://127.0.0.1:3128/"]:
+            trace = Trace(self.fname, proxy)
+            trace.session = FakeSession(
+                {"http://127.0.0.1:3128/_stats": FakeResponse(json_data={"a": 1})}
+            )
+            self.assertEqual(trace.proxy_stats(), {"a": 1})
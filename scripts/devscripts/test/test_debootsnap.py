@@ -15,12 +15,62 @@
 """Test debootsnap script."""
 
 import contextlib
+import hashlib
 import io
+import os
+import pathlib
+import random
 import tempfile
+import types
 import unittest
 import unittest.mock
 
-from debootsnap import main, parse_pkgs
+from debian.deb822 import Packages, Release
+
+from debootsnap import (
+    Deb,
+    OutputCache,
+    ar_member,
+    build_batch,
+    cover_archive,
+    cover_by_suite,
+    create_dummy_deb,
+    create_repo,
+    debs_by_pkg,
+    download_debs,
+    main,
+    parse_pkgs,
+    ranges_by_suite,
+    read_batch,
+    resolve_deb_snapshot,
+    resolve_debs,
+    resolve_metasnap,
+    tar_gz,
+)
+
+
+def write_deb(path, control: str) -> None:
+    """Write a binary package with the given control file and no data."""
+    with open(path, "wb") as f:
+        f.write(b"!<arch>\n")
+        f.write(ar_member("debian-binary", b"2.0\n"))
+        f.write(ar_member("control.tar.gz", tar_gz({"./control": control.encode()})))
+        f.write(ar_member("data.tar.gz", tar_gz({})))
+
+
+class FakeSnapshotSession:  # pylint: disable=too-few-public-methods
+    """Answer the binfiles queries of snapshot.debian.org with fixed data."""
+
+    def __init__(self, data: dict) -> None:
+        self.data = data
+        self.urls: list[str] = []
+
+    def get(self, url, params=None, timeout=None):  # pylint: disable=unused-argument
+        """Record the URL and return a response with the fixed data."""
+        self.urls.append(url)
+        response = unittest.mock.Mock()
+        response.json.return_value = self.data
+        return response
 
 
 class TestDebootsnap(unittest.TestCase):
@@ -35,9 +85,362 @@ class TestDebootsnap(unittest.TestCase):
             with self.assertRaisesRegex(SystemExit, "1"):
                 main(["--packages=pkg1:arch=ver1", "chroot.tar"])
         self.assertEqual(
-            stderr.getvalue(), "equivs-build is required but not installed\n"
+            stderr.getvalue(), "mmdebstrap is required but not installed\n"
+        )
+        which_mock.assert_called_once_with("mmdebstrap")
+
+    def test_jobs_must_be_positive(self) -> None:
+        """Test debootsnap rejects a number of jobs below one."""
+        stderr = io.StringIO()
+        with contextlib.redirect_stderr(stderr):
+            with self.assertRaisesRegex(SystemExit, "2"):
+                main(["--jobs=0", "--packages=pkg1:arch=ver1", "chroot.tar"])
+        self.assertIn("the number of jobs must be at least 1", stderr.getvalue())
+        stderr = io.StringIO()
+        with contextlib.redirect_stderr(stderr):
+            with self.assertRaisesRegex(SystemExit, "2"):
+                main(["--batch-jobs=-1", "--batch", "a.buildinfo"])
+        self.assertIn("--batch-jobs: the number of jobs", stderr.getvalue())
+
+    def test_create_repo(self) -> None:
+        """Test create_repo() writes a repository with the dummy package."""
+        with tempfile.TemporaryDirectory(prefix="devscripts-") as tmpdir:
+            os.mkdir(os.path.join(tmpdir, "cache"))
+            deb = os.path.join(tmpdir, "cache", "pkg1_ver1_all.deb")
+            create_dummy_deb(deb, [("pkg2", "arch", "ver2")])
+            create_repo(tmpdir, [("pkg1", "arch", "ver1")], {deb: "0" * 64})
+            with open(os.path.join(tmpdir, "cache", "Packages"), "rb") as f:
+                packages = list(Packages.iter_paragraphs(f, use_apt_pkg=False))
+            with open(os.path.join(tmpdir, "cache", "Release"), "rb") as f:
+                release = Release(f)
+        self.assertEqual(
+            [(p["Filename"], p["SHA256"], p["Depends"]) for p in packages][0],
+            ("./pkg1_ver1_all.deb", "0" * 64, "pkg2:arch (= ver2)"),
+        )
+        self.assertEqual(packages[1]["Depends"], "pkg1:arch (= ver1)")
+        self.assertEqual(release["Suite"], "dummysuite")
+        self.assertEqual(release["SHA256"][0]["name"], "Packages")
+
+    def test_output_cache(self) -> None:
+        """Test OutputCache reuses verified tarballs and evicts old ones."""
+        pkgs = [("pkg1", "arch", "ver1")]
+        built = []
+
+        def build(content, output):
+            built.append(output)
+            with open(output, "w", encoding="utf8") as f:
+                f.write(content)
+
+        def fail(output):
+            with open(output, "w", encoding="utf8") as f:
+                f.write("unverified")
+            raise AssertionError("packages differ")
+
+        with tempfile.TemporaryDirectory(prefix="devscripts-") as tmpdir:
+            cache = OutputCache(os.path.join(tmpdir, "cache"), max_size=10)
+            out = os.path.join(tmpdir, "out.tar")
+            stderr = io.StringIO()
+            with contextlib.redirect_stderr(stderr):
+                self.assertFalse(cache.get(pkgs, "arch", out))
+                with self.assertRaises(AssertionError):
+                    cache.build(pkgs, "arch", out, fail)
+                self.assertFalse(cache.get(pkgs, "arch", out))
+                cache.build(pkgs, "arch", out, lambda o: build("chroot1", o))
+                cache.build(pkgs, "arch", out, lambda o: build("chroot2", o))
+                self.assertEqual(len(built), 1)
+                with open(out, encoding="utf8") as f:
+                    self.assertEqual(f.read(), "chroot1")
+                # a different architecture is a different tarball which makes
+                # the cache exceed its maximum size
+                cache.build(pkgs, "other", out, lambda o: build("chroot3", o))
+                self.assertEqual(len(built), 2)
+                self.assertFalse(cache.get(pkgs, "arch", out))
+                self.assertTrue(cache.get(pkgs, "other", out))
+            # only the tarball of the other architecture is left
+            self.assertEqual(
+                [name[-4:] for name in os.listdir(os.path.join(tmpdir, "cache"))],
+                [".tar"],
+            )
+
+    @unittest.mock.patch("subprocess.check_output")
+    def test_resolve_debs(self, check_output_mock) -> None:
+        """Test resolve_debs() parses the output of apt-get --print-uris."""
+        check_output_mock.return_value = (
+            "'http://deb.debian.org/debian/pool/main/p/pkg1/pkg1_1%3aver1_all.deb'"
+            " pkg1_1%3aver1_all.deb 1234 SHA256:" + "AB" * 32 + "\n"
+            "'http://deb.debian.org/debian/pool/main/p/pkg2/pkg2_ver2_arch.deb'"
+            " pkg2_ver2_arch.deb 42 MD5Sum:" + "cd" * 16 + "\n"
+        )
+        pkgs = [("pkg1", "all", "1:ver1"), ("pkg2", "arch", "ver2")]
+        debs = resolve_debs(pkgs, {})
+        self.assertEqual(
+            [(deb.size, deb.hashname, deb.digest) for deb in debs],
+            [(1234, "sha256", "ab" * 32), (42, "md5", "cd" * 16)],
+        )
+        self.assertEqual(
+            [deb.filename for deb in debs],
+            ["pkg1_1:ver1_all.deb", "pkg2_ver2_arch.deb"],
+        )
+        self.assertEqual(
+            check_output_mock.call_args.args[0][-2:],
+            ["pkg1:all=1:ver1", "pkg2:arch=ver2"],
+        )
+        # a package apt-get did not print a URI for must not go unnoticed
+        with self.assertRaisesRegex(RuntimeError, "resolved 2 of 3 packages"):
+            resolve_debs(pkgs + [("pkg3", "arch", "ver3")], {})
+
+    @unittest.mock.patch("requests.Session")
+    def test_download_debs_once(self, session_mock) -> None:
+        """Test download_debs() downloads debs with the same name only once."""
+        content = b"deb content"
+        response = unittest.mock.MagicMock()
+        response.__enter__.return_value.iter_content.return_value = [content]
+        session_mock.return_value.get.return_value = response
+        uri = "http://deb.debian.org/debian/pool/main/p/pkg1/pkg1_ver1_all.deb"
+        deb = Deb(uri, len(content), "sha256", hashlib.sha256(content).hexdigest())
+        with tempfile.TemporaryDirectory(prefix="devscripts-") as tmpdir:
+            stderr = io.StringIO()
+            with contextlib.redirect_stderr(stderr):
+                deb_files = download_debs([deb, deb], pathlib.Path(tmpdir), None, 2)
+            self.assertEqual(os.listdir(tmpdir), ["pkg1_ver1_all.deb"])
+        self.assertEqual(deb_files, {f"{tmpdir}/pkg1_ver1_all.deb": deb.digest})
+        session_mock.return_value.get.assert_called_once()
+
+    def test_resolve_deb_snapshot_cache(self) -> None:
+        """Test resolve_deb_snapshot() only asks snapshot.debian.org once."""
+        other, sha1 = "1" * 40, "2" * 40
+        session = FakeSnapshotSession(
+            {
+                "result": [
+                    {"architecture": "other", "hash": other},
+                    {"architecture": "arch", "hash": sha1},
+                ],
+                "fileinfo": {
+                    other: [],
+                    sha1: [
+                        {
+                            "archive_name": "debian",
+                            "first_seen": "20230101T000000Z",
+                            "path": "/pool/main/p/pkg1",
+                            "name": "pkg1_1%3aver1_arch.deb",
+                            "size": 1234,
+                        }
+                    ],
+                },
+            }
+        )
+        with tempfile.TemporaryDirectory(prefix="devscripts-") as tmpdir:
+            with unittest.mock.patch.dict(os.environ, {"XDG_CACHE_HOME": tmpdir}):
+                debs = [
+                    resolve_deb_snapshot(session, "pkg1", "arch", "1:ver1")
+                    for _ in range(2)
+                ]
+        self.assertEqual(debs[0], debs[1])
+        self.assertEqual(
+            debs[0].uri,
+            "http://snapshot.debian.org/archive/debian/20230101T000000Z"
+            "/pool/main/p/pkg1/pkg1_1%3aver1_arch.deb",
+        )
+        self.assertEqual(
+            (debs[0].size, debs[0].hashname, debs[0].digest), (1234, "sha1", sha1)
+        )
+        self.assertEqual(
+            session.urls,
+            ["http://snapshot.debian.org/mr/binary/pkg1/1:ver1/binfiles"],
+        )
+
+    def test_resolve_metasnap_cache(self) -> None:
+        """Test resolve_metasnap() only asks metasnap.debian.net once."""
+        ranges = {
+            ("pkg1", "arch", "ver1"): [
+                ("sid", "main", "20230101T000000Z", "20230201T000000Z")
+            ],
+            ("pkg2", "arch", "ver2"): [
+                ("bookworm", "main", "20230101T000000Z", "20230301T000000Z")
+            ],
+        }
+        queries = []
+
+        def query(pkgsleft, archive, nativearch):
+            queries.append((tuple(sorted(pkgsleft)), archive, nativearch))
+            if archive == "debian":
+                return {pkg: ranges[pkg] for pkg in pkgsleft if pkg[0] == "pkg1"}
+            if archive == "debian-ports":
+                return {pkg: ranges[pkg] for pkg in pkgsleft if pkg[0] == "pkg2"}
+            return {}
+
+        pkgs = sorted(ranges)
+        with tempfile.TemporaryDirectory(prefix="devscripts-") as tmpdir:
+            with unittest.mock.patch.dict(os.environ, {"XDG_CACHE_HOME": tmpdir}):
+                with unittest.mock.patch("debootsnap.query_metasnap", query):
+                    first = resolve_metasnap(pkgs, "arch")
+                    self.assertEqual(len(queries), 6)
+                    second = resolve_metasnap(pkgs, "arch")
+                    self.assertEqual(len(queries), 6)
+                    # a package that was not seen before is queried on its own
+                    resolve_metasnap(pkgs + [("pkg3", "arch", "ver3")], "arch")
+        self.assertEqual(first, second)
+        self.assertEqual(
+            first,
+            {
+                ("pkg1", "arch", "ver1"): ("debian", ranges[("pkg1", "arch", "ver1")]),
+                ("pkg2", "arch", "ver2"): (
+                    "debian-ports",
+                    ranges[("pkg2", "arch", "ver2")],
+                ),
+            },
+        )
+        self.assertEqual(
+            {pkgsleft for pkgsleft, _, _ in queries[6:]},
+            {(("pkg3", "arch", "ver3"),)},
+        )
+
+    def assert_covers(self, sources, pkg2ranges) -> None:
+        """Assert that every package is contained in one of the sources."""
+        for pkg, ranges in pkg2ranges.items():
+            self.assertTrue(
+                any(
+                    source.suite == s
+                    and b <= source.timestamp <= e
+                    and c in source.components
+                    for source in sources
+                    for s, c, b, e in ranges
+                ),
+                pkg,
+            )
+
+    def test_cover_archive(self) -> None:
+        """Test cover_archive() needs fewer timestamps than cover_by_suite()."""
+        # sid contains all packages but each at a different time, while
+        # bookworm contains all but the last one at a single time
+        pkg2ranges = {
+            (f"pkg{i}", "arch", "ver"): [("sid", "main", f"2023010{i}", f"2023010{i}")]
+            for i in range(1, 5)
+        }
+        for i in range(1, 4):
+            pkg2ranges[(f"pkg{i}", "arch", "ver")].append(
+                ("bookworm", "contrib", "20230101", "20230201")
+            )
+        baseline = cover_by_suite("debian", ranges_by_suite(pkg2ranges), pkg2ranges)
+        self.assertEqual(len(baseline), 4)
+        timestamps: set[str] = set()
+        sources, saved = cover_archive("debian", pkg2ranges, timestamps)
+        self.assert_covers(sources, pkg2ranges)
+        self.assertEqual(
+            sorted((s.timestamp, s.suite, s.components) for s in sources),
+            [("20230104", "sid", ["main"]), ("20230201", "bookworm", ["contrib"])],
+        )
+        self.assertEqual(saved, 2)
+        self.assertEqual(timestamps, {"20230104", "20230201"})
+        # timestamps picked for another archive are reused
+        timestamps = {"20230104"}
+        sources, saved = cover_archive("debian-ports", pkg2ranges, timestamps)
+        self.assert_covers(sources, pkg2ranges)
+        self.assertEqual(timestamps, {"20230104", "20230201"})
+        self.assertEqual(saved, 2)
+
+    def test_cover_archive_random(self) -> None:
+        """Test cover_archive() is never worse than cover_by_suite()."""
+        rng = random.Random(1)
+        for _ in range(100):
+            pkg2ranges = {}
+            for i in range(rng.randint(1, 40)):
+                ranges = []
+                for suite in rng.sample(
+                    ["bookworm", "bullseye", "sid"], rng.randint(1, 3)
+                ):
+                    begin = rng.randint(0, 90)
+                    end = begin + rng.randint(0, 30)
+                    component = rng.choice(["main", "contrib"])
+                    ranges.append(
+                        (suite, component, f"2023{begin:04d}", f"2023{end:04d}")
+                    )
+                pkg2ranges[(f"pkg{i}", "arch", "ver")] = ranges
+            baseline = cover_by_suite("debian", ranges_by_suite(pkg2ranges), pkg2ranges)
+            sources, saved = cover_archive("debian", pkg2ranges, set())
+            self.assert_covers(sources, pkg2ranges)
+            for source in sources:
+                self.assertEqual(source.components, sorted(set(source.components)))
+            self.assertGreaterEqual(saved, 0)
+            self.assertEqual(
+                len({s.timestamp for s in sources}),
+                len({s.timestamp for s in baseline}) - saved,
+            )
+
+    def test_debs_by_pkg(self) -> None:
+        """Test debs_by_pkg() keys the debs of a batch by their control files."""
+        with tempfile.TemporaryDirectory(prefix="devscripts-") as tmpdir:
+            deb_files = {}
+            for name, arch, version in [
+                ("pkg1", "arch", "1:ver1"),
+                ("pkg2", "all", "ver2"),
+            ]:
+                path = os.path.join(tmpdir, f"{name}.deb")
+                write_deb(
+                    path,
+                    f"Package: {name}\nVersion: {version}\nArchitecture: {arch}\n",
+                )
+                deb_files[path] = name * 16
+            bypkg = debs_by_pkg(deb_files)
+        self.assertEqual(
+            bypkg,
+            {
+                ("pkg1", "arch", "1:ver1"): (
+                    os.path.join(tmpdir, "pkg1.deb"),
+                    "pkg1" * 16,
+                ),
+                ("pkg2", "all", "ver2"): (
+                    os.path.join(tmpdir, "pkg2.deb"),
+                    "pkg2" * 16,
+                ),
+            },
+        )
+
+    @unittest.mock.patch("debootsnap.compute_sources")
+    def test_build_batch_continues_after_failure(self, _) -> None:
+        """Test that one failing chroot does not stop the rest of a batch."""
+        built = []
+
+        def build(pkgs, _nativearch, output, _create):
+            if pkgs == ["broken"]:
+                raise OSError("no space left on device")
+            built.append(output)
+
+        pkgsets = {"a.buildinfo": ["broken"], "b.buildinfo": ["pkg"]}
+        cache = types.SimpleNamespace(build=build)
+        args = types.SimpleNamespace(batch_jobs=2, ignore_notfound=False)
+        stderr = io.StringIO()
+        with contextlib.redirect_stderr(stderr):
+            failed = build_batch("/pool", {}, pkgsets, "arch", "/out", cache, args)
+        self.assertEqual(failed, ["a.buildinfo"])
+        self.assertEqual(built, ["/out/b.tar"])
+        self.assertIn("no space left on device", stderr.getvalue())
+
+    def test_read_batch(self) -> None:
+        """Test read_batch() skips the buildinfo files it cannot use."""
+        with tempfile.TemporaryDirectory(prefix="devscripts-") as tmpdir:
+            buildinfos = {
+                "good": "Build-Architecture: arch\n"
+                "Installed-Build-Depends: pkg1 (= ver1), pkg2:other (= ver2)\n",
+                "noarch": "Installed-Build-Depends: pkg1 (= ver1)\n",
+                "bad": "Build-Architecture: arch\n"
+                "Installed-Build-Depends: pkg1 (>= ver1)\n",
+            }
+            for name, content in buildinfos.items():
+                with open(os.path.join(tmpdir, name), "w", encoding="utf8") as f:
+                    f.write(content)
+            paths = [os.path.join(tmpdir, n) for n in [*buildinfos, "missing"]]
+            failed: list[str] = []
+            stderr = io.StringIO()
+            with contextlib.redirect_stderr(stderr):
+                pkgsets, nativearch = read_batch(paths, failed)
+        self.assertEqual(nativearch, "arch")
+        self.assertEqual(
+            {path: sorted(pkgs) for path, pkgs in pkgsets.items()},
+            {paths[0]: [("pkg1", "arch", "ver1"), ("pkg2", "other", "ver2")]},
         )
-        which_mock.assert_called_once_with("equivs-build")
+        self.assertEqual(failed, paths[1:])
+        self.assertIn(f"{paths[1]} has no Build-Architecture field", stderr.getvalue())
 
     def test_parse_pkgs_from_file(self) -> None:
         """Test parse_pkgs() for a given file name."""
@@ -0,0 +1,422 @@
+# SPDX-License-Identifier: MIT
+
+"""Test the caching proxy used by debbisect and debootsnap."""
+
+import hashlib
+import http.client
+import http.server
+import json
+import lzma
+import os
+import pathlib
+import shutil
+import tempfile
+import threading
+import time
+import unittest
+import unittest.mock
+
+from devscripts.proxy import (
+    CacheIndex,
+    ProxyServer,
+    create_server,
+    dedup_cache,
+    setupcache,
+    verify_cache,
+)
+
+TIMESTAMP = "20240101T000000Z"
+
+
+class FakeSnapshot(http.server.BaseHTTPRequestHandler):
+    """Minimal imitation of snapshot.debian.org redirecting pool files."""
+
+    protocol_version = "HTTP/1.1"
+    files: dict[str, bytes] = {}
+    requests: list[str] = []
+
+    def do_GET(self) -> None:  # pylint: disable=invalid-name
+        """Serve /archive/ paths, redirecting pool files to /file/<sha1>."""
+        path = self.path
+        if path.startswith("http://"):
+            path = "/" + path.split("/", 3)[3]
+        self.requests.append(path)
+        if path.startswith("/file/"):
+            data = next(
+                (d for d in self.files.values() if hashlib.sha1(d).hexdigest() in path),
+                None,
+            )
+            if data is None:
+                self.send_error(404)
+                return
+        else:
+            name = path.split("/", 4)[4]
+            if name not in self.files:
+                self.send_error(404)
+                return
+            data = self.files[name]
+            if name.startswith("pool/"):
+                self.send_response(302)
+                self.send_header("Location", "/file/" + hashlib.sha1(data).hexdigest())
+                self.send_header("Content-Length", "0")
+                self.end_headers()
+                return
+        self.send_response(200)
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        # send the data slowly so that requests overlap
+        for i in range(0, len(data), 64 * 1024):
+            self.wfile.write(data[i : i + 64 * 1024])
+            time.sleep(0.01)
+
+    # pylint: disable=redefined-builtin
+    def log_message(self, format, *args) -> None:  # pylint: disable=arguments-differ
+        pass
+
+
+class TestProxy(unittest.TestCase):
+    """Test the caching proxy against a local fake snapshot server."""
+
+    def setUp(self) -> None:
+        FakeSnapshot.files = {
+            "pool/main/f/foo/foo_1_all.deb": os.urandom(1024 * 1024),
+            "dists/unstable/Release": b"Suite: unstable\n",
+        }
+        FakeSnapshot.requests = []
+        self.upstream = http.server.ThreadingHTTPServer(("127.0.0.1", 0), FakeSnapshot)
+        threading.Thread(target=self.upstream.serve_forever, daemon=True).start()
+        self.cachedir = tempfile.mkdtemp(prefix="devscripts-")
+        self.addCleanup(shutil.rmtree, self.cachedir)
+
+    def tearDown(self) -> None:
+        self.upstream.shutdown()
+        self.upstream.server_close()
+
+    def start_proxy(self, **kwargs) -> int:
+        port, teardown = setupcache(self.cachedir, 0, **kwargs)
+        self.addCleanup(teardown)
+        return port
+
+    def request(
+        self,
+        port: int,
+        name: str,
+        method: str = "GET",
+        timestamp: str = TIMESTAMP,
+        **headers: str,
+    ) -> http.client.HTTPResponse:
+        host = f"127.0.0.1:{self.upstream.server_address[1]}"
+        conn = http.client.HTTPConnection("127.0.0.1", port, timeout=30)
+        self.addCleanup(conn.close)
+        conn.request(
+            method,
+            f"http://{host}/archive/debian/{timestamp}/{name}",
+            headers={"Host": host, **headers},
+        )
+        return conn.getresponse()
+
+    def get(self, port: int, name: str) -> tuple[int, bytes]:
+        res = self.request(port, name)
+        return res.status, res.read()
+
+    def test_download_and_cache_hit(self) -> None:
+        """Test that a file is downloaded once and then served from the cache."""
+        port = self.start_proxy()
+        name = "pool/main/f/foo/foo_1_all.deb"
+        for _ in range(2):
+            self.assertEqual(self.get(port, name), (200, FakeSnapshot.files[name]))
+        self.assertEqual(len(FakeSnapshot.requests), 2)  # redirect and file
+        self.assertTrue(pathlib.Path(self.cachedir, name).is_file())
+
+    def test_concurrent_requests_share_download(self) -> None:
+        """Test that concurrent requests for the same file are coalesced."""
+        port = self.start_proxy(concurrent=True)
+        name = "pool/main/f/foo/foo_1_all.deb"
+        results = []
+        threads = [
+            threading.Thread(target=lambda: results.append(self.get(port, name)))
+            for _ in range(4)
+        ]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(results, 4 * [(200, FakeSnapshot.files[name])])
+        self.assertEqual(len(FakeSnapshot.requests), 2)
+        # the download is only moved into place after the clients received
+        # the last byte
+        deadline = time.monotonic() + 10
+        while (
+            not pathlib.Path(self.cachedir, name).exists()
+            and time.monotonic() < deadline
+        ):
+            time.sleep(0.01)
+        self.assertEqual(
+            os.listdir(pathlib.Path(self.cachedir, "pool/main/f/foo")),
+            ["foo_1_all.deb"],
+        )
+
+    def test_redirect_is_remembered(self) -> None:
+        """Test that the redirect to /file/ is skipped on the second download."""
+        port = self.start_proxy()
+        name = "pool/main/f/foo/foo_1_all.deb"
+        self.get(port, name)
+        # the proxy handles one request after the other, so once this cache
+        # hit was answered, the first download is finished
+        self.get(port, name)
+        os.unlink(pathlib.Path(self.cachedir, name))
+        FakeSnapshot.requests = []
+        res = self.request(port, name, timestamp="20240102T000000Z")
+        self.assertEqual((res.status, res.read()), (200, FakeSnapshot.files[name]))
+        self.assertEqual(len(FakeSnapshot.requests), 1)
+        self.assertTrue(FakeSnapshot.requests[0].startswith("/file/"))
+
+    def test_redirects_are_bounded(self) -> None:
+        """Test that only the most recently used redirects are remembered."""
+        names = ["pool/main/f/foo/foo_1_all.deb", "pool/main/b/bar/bar_1_all.deb"]
+        FakeSnapshot.files[names[1]] = b"bar"
+        with unittest.mock.patch.object(ProxyServer, "MAX_REDIRECTS", 1):
+            port = self.start_proxy()
+            for name in names + names[1:]:
+                self.get(port, name)
+            os.unlink(pathlib.Path(self.cachedir, names[0]))
+            FakeSnapshot.requests = []
+            self.assertEqual(
+                self.get(port, names[0]), (200, FakeSnapshot.files[names[0]])
+            )
+        self.assertEqual(len(FakeSnapshot.requests), 2)
+        self.assertFalse(FakeSnapshot.requests[0].startswith("/file/"))
+
+    def test_cache_hit_range_and_head(self) -> None:
+        """Test that HEAD and Range requests are answered from the cache."""
+        port = self.start_proxy()
+        name = "pool/main/f/foo/foo_1_all.deb"
+        data = FakeSnapshot.files[name]
+        self.get(port, name)
+        FakeSnapshot.requests = []
+
+        res = self.request(port, name, "HEAD")
+        self.assertEqual(res.status, 200)
+        self.assertEqual(res.getheader("Content-Length"), str(len(data)))
+        etag = res.getheader("ETag")
+        self.assertTrue(etag)
+
+        res = self.request(port, name, Range="bytes=100-199")
+        self.assertEqual(res.status, 206)
+        self.assertEqual(res.getheader("Content-Range"), f"bytes 100-199/{len(data)}")
+        self.assertEqual(res.read(), data[100:200])
+
+        res = self.request(port, name, Range="bytes=-10")
+        self.assertEqual((res.status, res.read()), (206, data[-10:]))
+
+        res = self.request(port, name, Range=f"bytes={len(data)}-")
+        self.assertEqual(res.status, 416)
+
+        res = self.request(port, name, **{"If-None-Match": etag})
+        self.assertEqual(res.status, 304)
+        self.assertEqual(FakeSnapshot.requests, [])
+
+    def test_dists_files_are_deduplicated(self) -> None:
+        """Test that identical indices of different timestamps share storage."""
+        port = self.start_proxy()
+        name = "dists/unstable/Release"
+        old = pathlib.Path(self.cachedir, "archive/debian/20231231T000000Z", name)
+        old.parent.mkdir(parents=True)
+        old.write_bytes(FakeSnapshot.files[name])
+        for timestamp in [TIMESTAMP, "20240102T000000Z"]:
+            res = self.request(port, name, timestamp=timestamp)
+            self.assertEqual((res.status, res.read()), (200, FakeSnapshot.files[name]))
+        # make sure the last download is finished
+        self.get(port, name)
+        paths = [
+            pathlib.Path(self.cachedir, "archive/debian", timestamp, name)
+            for timestamp in [TIMESTAMP, "20240102T000000Z"]
+        ]
+        self.assertTrue(os.path.samefile(*paths))
+        self.assertFalse(os.path.samefile(old, paths[0]))
+
+        self.assertEqual(dedup_cache(self.cachedir), (1, len(FakeSnapshot.files[name])))
+        self.assertTrue(os.path.samefile(old, paths[0]))
+
+    def test_least_recently_used_files_are_evicted(self) -> None:
+        """Test that the cache does not grow beyond its maximum size."""
+        FakeSnapshot.files = {
+            f"pool/main/f/foo/foo_{i}_all.deb": os.urandom(1000) for i in range(3)
+        }
+        port = self.start_proxy(max_size=2500)
+        for i in [0, 1, 0, 2]:
+            self.get(port, f"pool/main/f/foo/foo_{i}_all.deb")
+        # make sure the last download is finished
+        self.get(port, "pool/main/f/foo/foo_2_all.deb")
+        self.assertEqual(
+            sorted(os.listdir(pathlib.Path(self.cachedir, "pool/main/f/foo"))),
+            ["foo_0_all.deb", "foo_2_all.deb"],
+        )
+        index = CacheIndex(self.cachedir)
+        self.addCleanup(index.close)
+        self.assertEqual(index.total_size(), 2000)
+        self.assertEqual(index.partial_files(), [])
+
+    def test_eviction_keeps_running_total(self) -> None:
+        """Test that the size of the whole cache is only computed if needed."""
+        index = CacheIndex(self.cachedir)
+        self.addCleanup(index.close)
+        pool = pathlib.Path(self.cachedir, "pool/main/f/foo")
+        pool.mkdir(parents=True)
+        paths = [pool / f"foo_{i}_all.deb" for i in range(3)]
+        index.add_checksums([(index.key(paths[0]), "0" * 64)], parsed="1" * 64)
+        for i, path in enumerate(paths[:2]):
+            path.write_bytes(b"x" * 1000)
+            index.add(path, 1000)
+            index.execute(
+                "UPDATE files SET atime = ? WHERE path = ?", (i, index.key(path))
+            )
+        self.assertEqual(index.evict(2500), 0)
+        with unittest.mock.patch.object(
+            index, "total_size", wraps=index.total_size
+        ) as total_size:
+            index.remove(paths[1])
+            index.add(paths[1], 1000)
+            index.execute(
+                "UPDATE files SET atime = 1 WHERE path = ?", (index.key(paths[1]),)
+            )
+            self.assertEqual(index.evict(2500), 0)
+            total_size.assert_not_called()
+            paths[2].write_bytes(b"x" * 1000)
+            index.add(paths[2], 1000)
+            self.assertEqual(index.evict(2500), 1000)
+            total_size.assert_called_once()
+        self.assertEqual(index.size, 2000)
+        self.assertFalse(paths[0].exists())
+        self.assertIsNone(index.expected_sha256(paths[0]))
+
+    def test_index_is_rebuilt_for_existing_cache(self) -> None:
+        """Test that files cached without an index are found."""
+        pathlib.Path(self.cachedir, "pool/main/f/foo").mkdir(parents=True)
+        pathlib.Path(self.cachedir, "pool/main/f/foo/foo_1_all.deb").write_bytes(b"deb")
+        pathlib.Path(self.cachedir, "pool/main/f/foo/foo_2_all.1234.part").touch()
+        index = CacheIndex(self.cachedir)
+        self.addCleanup(index.close)
+        self.assertEqual(index.total_size(), 3)
+        self.assertEqual(
+            index.partial_files(),
+            [pathlib.Path(self.cachedir, "pool/main/f/foo/foo_2_all.1234.part")],
+        )
+
+    def test_shared_server(self) -> None:
+        """Test the standalone proxy that several processes can share."""
+        httpd = create_server(self.cachedir, "127.0.0.1", 0, concurrent=True)
+        threading.Thread(target=httpd.serve_forever, daemon=True).start()
+        self.addCleanup(httpd.server_close)
+        self.addCleanup(httpd.shutdown)
+        port = httpd.server_address[1]
+        name = "pool/main/f/foo/foo_1_all.deb"
+        for _ in range(2):
+            self.assertEqual(self.get(port, name), (200, FakeSnapshot.files[name]))
+        self.assertEqual(len(FakeSnapshot.requests), 2)
+
+    def test_stats(self) -> None:
+        """Test that hits, misses and transferred bytes are counted."""
+        port = self.start_proxy()
+        name = "pool/main/f/foo/foo_1_all.deb"
+        size = len(FakeSnapshot.files[name])
+        for _ in range(2):
+            self.get(port, name)
+        self.request(port, name, "HEAD").read()
+        conn = http.client.HTTPConnection("127.0.0.1", port, timeout=30)
+        self.addCleanup(conn.close)
+        conn.request("GET", "/_stats")
+        res = conn.getresponse()
+        self.assertEqual(res.status, 200)
+        stats = json.loads(res.read())
+        self.assertEqual(stats["requests"], 3)
+        self.assertEqual(stats["hits"], 2)
+        self.assertEqual(stats["misses"], 1)
+        self.assertEqual(stats["bytes_from_cache"], size)
+        self.assertEqual(stats["bytes_from_upstream"], size)
+        self.assertEqual(stats["redirects"], 1)
+        self.assertEqual(stats["upstream_ttfb"]["count"], 2)
+
+    def add_indices(self, deb_sha256: str) -> None:
+        """Serve an InRelease and Packages.xz file listing foo_1_all.deb."""
+        packages = lzma.compress(
+            b"Package: foo\nVersion: 1\n"
+            b"Filename: pool/main/f/foo/foo_1_all.deb\n"
+            b"SHA256: " + deb_sha256.encode() + b"\n\n"
+        )
+        FakeSnapshot.files["dists/unstable/main/binary-all/Packages.xz"] = packages
+        FakeSnapshot.files["dists/unstable/InRelease"] = (
+            b"-----BEGIN PGP SIGNED MESSAGE-----\nHash: SHA512\n\n"
+            b"Suite: unstable\nSHA256:\n "
+            + hashlib.sha256(packages).hexdigest().encode()
+            + f" {len(packages)} main/binary-all/Packages.xz\n".encode()
+            + b"-----BEGIN PGP SIGNATURE-----\n\nabc\n-----END PGP SIGNATURE-----\n"
+        )
+
+    def test_corrupt_download_is_quarantined(self) -> None:
+        """Test that files not matching the checksum in Packages are not cached."""
+        name = "pool/main/f/foo/foo_1_all.deb"
+        self.add_indices(hashlib.sha256(b"something else").hexdigest())
+        port = self.start_proxy()
+        for index in ["InRelease", "main/binary-all/Packages.xz"]:
+            self.assertEqual(self.get(port, f"dists/unstable/{index}")[0], 200)
+        res = self.request(port, name)
+        self.assertEqual(res.status, 200)
+        # the response is cut short so that apt does not accept the file
+        with self.assertRaises(http.client.IncompleteRead):
+            res.read()
+        # make sure the last download is finished
+        self.get(port, "dists/unstable/InRelease")
+        self.assertFalse(pathlib.Path(self.cachedir, name).exists())
+        self.assertTrue(pathlib.Path(self.cachedir, "quarantine", name).is_file())
+
+        FakeSnapshot.files[name] = b"something else"
+        self.assertEqual(self.get(port, name), (200, b"something else"))
+        self.get(port, "dists/unstable/InRelease")
+        self.assertTrue(pathlib.Path(self.cachedir, name).is_file())
+
+    def test_corrupt_download_fails_for_followers(self) -> None:
+        """Test that clients sharing a corrupt download do not receive it."""
+        name = "pool/main/f/foo/foo_1_all.deb"
+        self.add_indices(hashlib.sha256(b"something else").hexdigest())
+        port = self.start_proxy(concurrent=True)
+        for index in ["InRelease", "main/binary-all/Packages.xz"]:
+            self.assertEqual(self.get(port, f"dists/unstable/{index}")[0], 200)
+        results = []
+
+        def fetch() -> None:
+            res = self.request(port, name)
+            try:
+                results.append((res.status, len(res.read())))
+            except http.client.IncompleteRead:
+                results.append((res.status, None))
+
+        threads = [threading.Thread(target=fetch) for _ in range(4)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(len(results), 4)
+        for status, length in results:
+            self.assertTrue(status == 502 or length is None, (status, length))
+        self.assertFalse(pathlib.Path(self.cachedir, name).exists())
+
+    def test_verify_cache(self) -> None:
+        """Test that an existing cache is checked against its indices."""
+        name = "pool/main/f/foo/foo_1_all.deb"
+        self.add_indices(hashlib.sha256(FakeSnapshot.files[name]).hexdigest())
+        port = self.start_proxy()
+        for index in ["InRelease", "Release", "main/binary-all/Packages.xz"]:
+            self.get(port, f"dists/unstable/{index}")
+        self.get(port, name)
+        self.get(port, name)
+        self.assertEqual(verify_cache(self.cachedir), (2, 0, 2))
+        # throw away what the proxy learned while downloading
+        index = CacheIndex(self.cachedir)
+        index.execute("DELETE FROM checksums")
+        index.execute("DELETE FROM parsed")
+        index.close()
+        pathlib.Path(self.cachedir, name).write_bytes(b"corrupt")
+        self.assertEqual(verify_cache(self.cachedir, jobs=2), (1, 1, 2))
+        self.assertTrue(pathlib.Path(self.cachedir, "quarantine", name).is_file())
+        self.assertFalse(pathlib.Path(self.cachedir, name).exists())
@@ -14,7 +14,7 @@
 
 # this script is part of debbisect and usually called by debbisect itself
 #
-# it accepts six or eight arguments:
+# it accepts six, eight or nine arguments:
 #    1. dependencies
 #    2. script name or shell snippet
 #    3. mirror URL
@@ -23,6 +23,7 @@
 #    6. components
 #    7. (optional) second mirror URL
 #    8. (optional) package to upgrade
+#    9. (optional) label for the pkglist file name
 #
 # It will create an ephemeral chroot using mmdebstrap using (3.) as mirror,
 # (4.) as architecture, (5.) as suite and (6.) as components, install the
@@ -32,14 +33,37 @@
 #
 # If not only six but eight arguments are given, then the second mirror URL
 # (7.) will be added to the apt sources and the single package (8.) will be
-# upgraded to its version from (7.).
+# upgraded to its version from (7.). The package can also be a
+# space-separated list of packages which are then upgraded together. In that
+# case the label (9.) is used instead of the package in the name of the
+# pkglist file.
+#
+# If DEBIAN_BISECT_CHROOT_BASE is set to a tarball of the chroot of an earlier
+# timestamp, the chroot is created from it by upgrading it to the packages
+# from (3.) instead of from scratch. DEBIAN_BISECT_CHROOT_PKGS is then the
+# sorted list of "package version" lines of a fresh chroot. If the upgraded
+# chroot does not have exactly these packages, the file
+# $DEBIAN_BISECT_CHROOT_PKGS.differ is created and the script is not run.
+# Packages that are no longer needed or no longer available from (3.) are
+# removed before the comparison because a fresh chroot would not have them.
+# If DEBIAN_BISECT_CHROOT_SAVE is set, a tarball of the chroot is stored there
+# before the script is run.
+#
+# If DEBIAN_BISECT_SIMULATE is set, no chroot is created and no script is run.
+# Instead, mmdebstrap --simulate is run with the options of a fresh chroot, so
+# that debbisect can tell from its output which packages a fresh chroot of
+# (3.) would have.
+#
+# If DEBIAN_BISECT_TRACE is set, the names of the phases "upgrade" and
+# "script" are appended to that file together with the UNIX time at which
+# they start, so that debbisect can tell how long creating the chroot took.
 #
 # shellcheck disable=SC2016
 
 set -exu
 
-if [ $# -ne 6 ] && [ $# -ne 8 ]; then
-	echo "usage: $0 depends script mirror1 architecture suite components [mirror2 toupgrade]"
+if [ $# -ne 6 ] && [ $# -ne 8 ] && [ $# -ne 9 ]; then
+	echo "usage: $0 depends script mirror1 architecture suite components [mirror2 toupgrade [label]]"
 	exit 1
 fi
 
@@ -50,6 +74,12 @@ architecture=$4
 suite=$5
 components=$6
 
+if [ $# -ge 8 ]; then
+	mirror2=$7
+	toupgrade=$8
+	label=${9:-$toupgrade}
+fi
+
 # The following hacks are needed to go back as far as 2006-08-10:
 #
 #  - Acquire::Check-Valid-Until "false" allows Release files with an expired
@@ -59,53 +89,79 @@ components=$6
 #  - /usr/share/keyrings lets apt use debian-archive-removed-keys.gpg
 #  - /usr/share/mmdebstrap/hooks/jessie-or-older performs some setup that is
 #    only required for Debian Jessie or older
-#
-if [ $# -eq 6 ]; then
+snapshot_mmdebstrap() {
 	mmdebstrap \
 		--verbose \
 		--aptopt='Acquire::Check-Valid-Until "false"' \
 		--aptopt='Apt::Key::gpgvcommand "/usr/libexec/mmdebstrap/gpgvnoexpkeysig"' \
 		--aptopt='Apt::Hashes::SHA1::Weak "yes"' \
 		--keyring=/usr/share/keyrings \
-		--hook-dir=/usr/share/mmdebstrap/hooks/maybe-jessie-or-older \
-		--hook-dir=/usr/share/mmdebstrap/hooks/maybe-merged-usr \
 		--skip=check/signed-by \
-		--variant=apt \
 		--components="$components" \
-		--include="$depends" \
 		--architecture="$architecture" \
+		"$@"
+}
+
+# From here on, the positional parameters are the mmdebstrap options that
+# create the chroot with the dependencies installed. A chroot created from a
+# base tarball of an earlier timestamp may contain packages that a fresh
+# chroot of the current timestamp would not have. Packages that are no longer
+# needed or no longer available are removed from it and then the installed
+# packages are compared with the ones of a fresh chroot.
+if [ -n "${DEBIAN_BISECT_CHROOT_BASE:-}" ] && [ -z "${DEBIAN_BISECT_SIMULATE:-}" ]; then
+	set -- \
+		--variant=custom \
+		--setup-hook='tar-in "'"$DEBIAN_BISECT_CHROOT_BASE"'" /' \
+		--customize-hook='echo "deb '"$mirror1 $suite $(echo "$components" | tr ',' ' ')"'" > "$1"/etc/apt/sources.list' \
+		--customize-hook='chroot "$1" apt-get update' \
+		--customize-hook='chroot "$1" env DEBIAN_FRONTEND=noninteractive DEBCONF_NONINTERACTIVE_SEEN=true apt-get --yes dist-upgrade' \
+		--customize-hook='chroot "$1" env DEBIAN_FRONTEND=noninteractive DEBCONF_NONINTERACTIVE_SEEN=true apt-get --yes install --no-install-recommends '"$(echo "$depends" | tr ',' ' ')" \
+		--customize-hook='chroot "$1" env DEBIAN_FRONTEND=noninteractive DEBCONF_NONINTERACTIVE_SEEN=true apt-get --yes autoremove --purge' \
+		--customize-hook='obsolete=$(chroot "$1" apt list --installed 2>/dev/null | sed -n "s#/.*,local]\$##p"); [ -z "$obsolete" ] || chroot "$1" env DEBIAN_FRONTEND=noninteractive DEBCONF_NONINTERACTIVE_SEEN=true apt-get --yes purge $obsolete || true' \
+		--customize-hook='chroot "$1" dpkg-query --show --showformat "\${db:Status-Abbrev} \${Package} \${Version}\n" | sed -n "s/^ii  //p" | LC_ALL=C sort -u | cmp -s - "$DEBIAN_BISECT_CHROOT_PKGS" || { touch "$DEBIAN_BISECT_CHROOT_PKGS.differ"; exit 1; }'
+else
+	set -- \
+		--hook-dir=/usr/share/mmdebstrap/hooks/maybe-jessie-or-older \
+		--hook-dir=/usr/share/mmdebstrap/hooks/maybe-merged-usr \
+		--variant=apt \
+		--include="$depends"
+fi
+if [ -n "${DEBIAN_BISECT_SIMULATE:-}" ]; then
+	snapshot_mmdebstrap --simulate "$@" "$suite" /dev/null "$mirror1"
+	exit 0
+fi
+if [ -n "${DEBIAN_BISECT_CHROOT_SAVE:-}" ]; then
+	# store the chroot before the script has a chance to modify it
+	set -- "$@" \
+		--customize-hook='tar-out / "'"$DEBIAN_BISECT_CHROOT_SAVE"'.tmp"' \
+		--customize-hook='mv "'"$DEBIAN_BISECT_CHROOT_SAVE"'.tmp" "'"$DEBIAN_BISECT_CHROOT_SAVE"'"'
+fi
+
+if [ -z "${toupgrade:-}" ]; then
+	snapshot_mmdebstrap \
+		"$@" \
 		--customize-hook='chroot "$1" sh -c "dpkg-query -W > /pkglist"' \
 		--customize-hook='download /pkglist ./debbisect.'"$DEBIAN_BISECT_TIMESTAMP"'.pkglist' \
 		--customize-hook='rm "$1"/pkglist' \
 		--customize-hook='chroot "$1" dpkg-query --list | cat' \
+		--customize-hook='[ -z "${DEBIAN_BISECT_TRACE:-}" ] || echo "script $(date +%s.%N)" >> "$DEBIAN_BISECT_TRACE"' \
 		--customize-hook="$script" \
 		"$suite" \
 		- \
 		"$mirror1" \
 		>/dev/null
-elif [ $# -eq 8 ]; then
-	mirror2=$7
-	toupgrade=$8
-	mmdebstrap \
-		--verbose \
-		--aptopt='Acquire::Check-Valid-Until "false"' \
-		--aptopt='Apt::Key::gpgvcommand "/usr/libexec/mmdebstrap/gpgvnoexpkeysig"' \
-		--aptopt='Apt::Hashes::SHA1::Weak "yes"' \
-		--keyring=/usr/share/keyrings \
-		--hook-dir=/usr/share/mmdebstrap/hooks/maybe-jessie-or-older \
-		--hook-dir=/usr/share/mmdebstrap/hooks/maybe-merged-usr \
-		--skip=check/signed-by \
-		--variant=apt \
-		--components="$components" \
-		--include="$depends" \
-		--architecture="$architecture" \
+else
+	snapshot_mmdebstrap \
+		"$@" \
+		--customize-hook='[ -z "${DEBIAN_BISECT_TRACE:-}" ] || echo "upgrade $(date +%s.%N)" >> "$DEBIAN_BISECT_TRACE"' \
 		--customize-hook='echo "deb '"$mirror2 $suite $(echo "$components" | tr ',' ' ')"'" > "$1"/etc/apt/sources.list' \
 		--customize-hook='chroot "$1" apt-get update' \
 		--customize-hook='chroot "$1" env DEBIAN_FRONTEND=noninteractive DEBCONF_NONINTERACTIVE_SEEN=true apt-get --yes install --no-install-recommends '"$toupgrade" \
 		--customize-hook='chroot "$1" sh -c "dpkg-query -W > /pkglist"' \
-		--customize-hook='download /pkglist ./debbisect.'"$DEBIAN_BISECT_TIMESTAMP.$toupgrade"'.pkglist' \
+		--customize-hook='download /pkglist ./debbisect.'"$DEBIAN_BISECT_TIMESTAMP.$label"'.pkglist' \
 		--customize-hook='rm "$1"/pkglist' \
 		--customize-hook='chroot "$1" dpkg-query --list | cat' \
+		--customize-hook='[ -z "${DEBIAN_BISECT_TRACE:-}" ] || echo "script $(date +%s.%N)" >> "$DEBIAN_BISECT_TRACE"' \
 		--customize-hook="$script" \
 		"$suite" \
 		- \
@@ -14,7 +14,7 @@
 
 # this script is part of debbisect and usually called by debbisect itself
 #
-# it accepts eight or ten arguments:
+# it accepts eight, ten or eleven arguments:
 #    1. dependencies
 #    2. script name or shell snippet
 #    3. mirror URL
@@ -25,6 +25,7 @@
 #    8. disksize
 #    9. (optional) second mirror URL
 #   10. (optional) package to upgrade
+#   11. (optional) label for the pkglist file name
 #
 # It will create an ephemeral qemu virtual machine using mmdebstrap and
 # guestfish using (3.) as mirror, (4.) as architecture, (5.) as suite and
@@ -35,14 +36,17 @@
 #
 # If not only six but eight arguments are given, then the second mirror URL
 # (9.) will be added to the apt sources and the single package (10.) will be
-# upgraded to its version from (9.).
+# upgraded to its version from (9.). The package can also be a
+# space-separated list of packages which are then upgraded together. In that
+# case the label (11.) is used instead of the package in the name of the
+# pkglist file.
 #
 # shellcheck disable=SC2016
 
 set -exu
 
-if [ $# -ne 8 ] && [ $# -ne 10 ]; then
-	echo "usage: $0 depends script mirror1 architecture suite components memsize disksize [mirror2 toupgrade]"
+if [ $# -ne 8 ] && [ $# -ne 10 ] && [ $# -ne 11 ]; then
+	echo "usage: $0 depends script mirror1 architecture suite components memsize disksize [mirror2 toupgrade [label]]"
 	exit 1
 fi
 
@@ -55,9 +59,10 @@ components=$6
 memsize=$7
 disksize=$8
 
-if [ $# -eq 10 ]; then
+if [ $# -ge 10 ]; then
 	mirror2=$9
 	toupgrade=${10}
+	label=${11:-$toupgrade}
 fi
 
 TMPDIR=$(mktemp --tmpdir --directory debbisect_qemu.XXXXXXXXXX)
@@ -144,21 +149,22 @@ fi
 
 # in its ten-argument form, a single package has to be upgraded to its
 # version from the first bad timestamp
-if [ $# -eq 10 ]; then
+if [ $# -ge 10 ]; then
 	# replace content of sources.list with first bad timestamp
 	mirror2=$(echo "$mirror2" | sed 's/http:\/\/127.0.0.1:/http:\/\/10.0.2.2:/')
 	echo "deb $mirror2 $suite $(echo "$components" | tr ',' ' ')" | ssh -F "$TMPDIR/config" qemu "cat > /etc/apt/sources.list"
 	ssh -F "$TMPDIR/config" qemu apt-get update
 	# upgrade a single package (and whatever else apt deems necessary)
 	before=$(ssh -F "$TMPDIR/config" qemu dpkg-query -W)
-	ssh -F "$TMPDIR/config" qemu env DEBIAN_FRONTEND=noninteractive DEBCONF_NONINTERACTIVE_SEEN=true apt-get --yes install --no-install-recommends "$toupgrade"
+	# shellcheck disable=SC2086
+	ssh -F "$TMPDIR/config" qemu env DEBIAN_FRONTEND=noninteractive DEBCONF_NONINTERACTIVE_SEEN=true apt-get --yes install --no-install-recommends $toupgrade
 	after=$(ssh -F "$TMPDIR/config" qemu dpkg-query -W)
 	# make sure that something was upgraded
 	if [ "$before" = "$after" ]; then
 		echo "nothing got upgraded -- this should never happen" >&2
 		exit 1
 	fi
-	ssh -F "$TMPDIR/config" qemu dpkg-query -W > "./debbisect.$DEBIAN_BISECT_TIMESTAMP.$toupgrade.pkglist"
+	ssh -F "$TMPDIR/config" qemu dpkg-query -W > "./debbisect.$DEBIAN_BISECT_TIMESTAMP.$label.pkglist"
 else
 	ssh -F "$TMPDIR/config" qemu dpkg-query -W > "./debbisect.$DEBIAN_BISECT_TIMESTAMP.pkglist"
 fi